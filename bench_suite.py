@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+"""htq benchmark suite
+
+Runs each scenario against a local stub HTTP upstream at each thread count
+and reports throughput with p50/p95/p99 latency. Results are written as JSON
+so runs can be compared across versions.
+
+Scenarios:
+    send        htq.send() calls
+    receive     Draining the queue with htq.receive() against the upstream
+    cancel      Canceling queued and completed requests
+    http        POST / and GET /<uuid>/status/ on the REST service
+    e2e         POST / then blocking GET /<uuid>/response/ with workers running
+
+Usage:
+    bench_suite.py [options] [<scenario>...]
+
+Options:
+    -h --help               Show this screen.
+    -n <n>                  Number of operations per run [default: 1000].
+    --threads <threads>     Comma-separated thread counts [default: 1,4,16].
+    --latency <ms>          Upstream latency in milliseconds [default: 0].
+    --size <bytes>          Upstream response body size [default: 64].
+    --storage <url>         Storage backend URL, defaults to the Redis client.
+    --output <file>         Write the results as JSON to a file.
+    --compare <file>        Compare throughput against previous results.
+    --tolerance <ratio>     Allowed throughput drop when comparing [default: 0.1].
+"""  # noqa
+
+import sys
+import json
+import time
+import socket
+import logging
+import platform
+import threading
+from queue import Queue, Empty
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import requests
+from docopt import docopt
+from werkzeug.serving import make_server
+import htq
+from htq import service
+from htq.db import get_redis_client, set_backend
+
+
+SCENARIOS = ('send', 'receive', 'cancel', 'http', 'e2e')
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+
+        if length:
+            self.rfile.read(length)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    do_GET = do_POST = do_DELETE = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class Upstream(ThreadingMixIn, HTTPServer):
+    "Stub upstream service with a fixed latency and response body."
+    daemon_threads = True
+
+    def __init__(self, latency=0, size=64):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), UpstreamHandler)
+        self.latency = latency
+        self.body = b'x' * size
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+
+def serve(server):
+    "Runs a server in a daemon thread."
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
+
+
+def percentile(values, p):
+    "Nearest-rank percentile of sorted values."
+    if not values:
+        return None
+
+    i = max(int(round(p / 100.0 * len(values))) - 1, 0)
+
+    return values[min(i, len(values) - 1)]
+
+
+def run_threads(threads, func, items):
+    """Applies func to each item using a pool of threads.
+
+    Returns the elapsed time of the run and the latency of each call in
+    milliseconds.
+    """
+    queue = Queue()
+    latencies = []
+    lock = threading.Lock()
+
+    for item in items:
+        queue.put(item)
+
+    def work():
+        local = []
+
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                break
+
+            t0 = time.perf_counter()
+            func(item)
+            local.append((time.perf_counter() - t0) * 1000)
+
+        with lock:
+            latencies.extend(local)
+
+    pool = [threading.Thread(target=work) for _ in range(threads)]
+
+    t0 = time.perf_counter()
+
+    for t in pool:
+        t.start()
+
+    for t in pool:
+        t.join()
+
+    return time.perf_counter() - t0, latencies
+
+
+class Workers(object):
+    "Worker threads draining the queue like `htq worker`."
+    def __init__(self, threads):
+        self.stopped = threading.Event()
+        self.pool = [threading.Thread(target=self.run, daemon=True)
+                     for _ in range(threads)]
+
+    def run(self):
+        client = get_redis_client()
+
+        while not self.stopped.is_set():
+            item = client.brpop(htq.api.REQ_SEND_QUEUE, timeout=1)
+
+            if item:
+                htq.receive(item[1])
+
+    def __enter__(self):
+        for t in self.pool:
+            t.start()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+
+        for t in self.pool:
+            t.join()
+
+
+def bench_send(ctx, threads, n):
+    return run_threads(threads, lambda i: htq.send(ctx['url']), range(n))
+
+
+def bench_receive(ctx, threads, n):
+    for i in range(n):
+        htq.send(ctx['url'])
+
+    client = get_redis_client()
+
+    def receive(i):
+        htq.receive(client.rpop(htq.api.REQ_SEND_QUEUE))
+
+    return run_threads(threads, receive, range(n))
+
+
+def bench_cancel(ctx, threads, n):
+    uuids = [htq.send(ctx['url'])['uuid'] for i in range(n)]
+
+    # Complete half of the requests
+    for uuid in uuids[:n // 2]:
+        htq.receive(uuid)
+
+    return run_threads(threads, htq.cancel, uuids)
+
+
+def bench_http(ctx, threads, n):
+    local = threading.local()
+
+    def call(i):
+        s = getattr(local, 'session', None)
+
+        if s is None:
+            s = local.session = requests.Session()
+
+        rp = s.post(ctx['api'], data=json.dumps({'url': ctx['url']}),
+                    headers={'Content-Type': 'application/json'},
+                    allow_redirects=False)
+
+        s.get(rp.headers['Location'] + 'status/').raise_for_status()
+
+    return run_threads(threads, call, range(n))
+
+
+def bench_e2e(ctx, threads, n):
+    local = threading.local()
+
+    def call(i):
+        s = getattr(local, 'session', None)
+
+        if s is None:
+            s = local.session = requests.Session()
+
+        rp = s.post(ctx['api'], data=json.dumps({'url': ctx['url']}),
+                    headers={'Content-Type': 'application/json'},
+                    allow_redirects=False)
+
+        s.get(rp.headers['Location'] + 'response/').raise_for_status()
+
+    with Workers(threads):
+        return run_threads(threads, call, range(n))
+
+
+def run(scenarios, thread_counts, n, latency, size):
+    upstream = serve(Upstream(latency=latency, size=size))
+    api = serve(make_server('127.0.0.1', 0, service.app, threaded=True))
+
+    ctx = {
+        'url': upstream.url,
+        'api': 'http://127.0.0.1:{}/'.format(api.server_port),
+    }
+
+    results = []
+
+    try:
+        for scenario in scenarios:
+            func = globals()['bench_' + scenario]
+
+            for threads in thread_counts:
+                htq.flush()
+
+                elapsed, latencies = func(ctx, threads, n)
+                latencies.sort()
+
+                result = {
+                    'scenario': scenario,
+                    'threads': threads,
+                    'n': len(latencies),
+                    'seconds': elapsed,
+                    'throughput': len(latencies) / elapsed,
+                    'p50': percentile(latencies, 50),
+                    'p95': percentile(latencies, 95),
+                    'p99': percentile(latencies, 99),
+                }
+
+                print('{scenario:<8} threads={threads:<3} n={n:<6} '
+                      '{throughput:>9.1f}/s  p50={p50:.2f}ms '
+                      'p95={p95:.2f}ms  p99={p99:.2f}ms'.format(**result))
+
+                results.append(result)
+    finally:
+        htq.flush()
+        api.shutdown()
+        upstream.shutdown()
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    "Prints the throughput change per run and returns the regressions."
+    previous = {(r['scenario'], r['threads']): r for r in baseline['results']}
+    regressions = []
+
+    for r in results:
+        prev = previous.get((r['scenario'], r['threads']))
+
+        if not prev:
+            continue
+
+        ratio = r['throughput'] / prev['throughput']
+
+        print('{:<8} threads={:<3} {:+.1%}'.format(
+            r['scenario'], r['threads'], ratio - 1))
+
+        if ratio < 1 - tolerance:
+            regressions.append(r)
+
+    return regressions
+
+
+if __name__ == '__main__':
+    options = docopt(__doc__)
+
+    # Silence the request log of the REST service and htq's own logging
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    htq.logger.setLevel(logging.CRITICAL)
+
+    scenarios = options['<scenario>'] or SCENARIOS
+
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            sys.exit('unknown scenario "{}"'.format(scenario))
+
+    if options['--storage']:
+        set_backend(options['--storage'])
+
+    thread_counts = [int(t) for t in options['--threads'].split(',')]
+
+    params = {
+        'n': int(options['-n']),
+        'latency': float(options['--latency']) / 1000,
+        'size': int(options['--size']),
+    }
+
+    results = run(scenarios, thread_counts, **params)
+
+    output = {
+        'version': htq.__version__,
+        'python': platform.python_version(),
+        'host': socket.gethostname(),
+        'time': int(time.time()),
+        'storage': options['--storage'] or 'redis',
+        'params': params,
+        'results': results,
+    }
+
+    if options['--output']:
+        with open(options['--output'], 'w') as f:
+            json.dump(output, f, indent=4)
+
+    if options['--compare']:
+        with open(options['--compare']) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline,
+                              float(options['--tolerance']))
+
+        if regressions:
+            sys.exit('{} regression(s) found'.format(len(regressions)))
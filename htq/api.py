@@ -1,25 +1,59 @@
+import os
 import json
+import base64
+import codecs
 import time
+import socket
 import redis
 import requests
 import logging
 from uuid import uuid4
+from urllib.parse import urlparse
+from . import metrics, encoding
+from .archive import get_archive
+from .breaker import BREAKER_KEY, CircuitBreaker, CircuitOpen
 from .db import get_redis_client
 
 
 __all__ = (
     'send',
+    'send_many',
     'receive',
+    'latency',
     'queued',
     'request',
     'status',
+    'statuses',
+    'version',
     'response',
+    'responses',
+    'body',
     'pop',
     'push',
     'cancel',
+    'pop_cancel',
+    'requeue_cancel_notices',
+    'receive_cancel',
     'purge',
+    'sweep',
+    'requeue_deferred',
+    'archive',
+    'register_worker',
+    'heartbeat',
+    'claim',
+    'release',
+    'unregister_worker',
+    'workers',
+    'reap',
     'flush',
     'size',
+    'tenants',
+    'set_weight',
+    'timings',
+    'slow_tasks',
+    'set_compact',
+    'add_hook',
+    'remove_hook',
     'logger',
     'SUCCESS',
     'QUEUED',
@@ -27,24 +61,130 @@ __all__ = (
     'PENDING',
     'TIMEOUT',
     'ERROR',
+    'EXPIRED',
 )
 
 
 # Default request timeout
 DEFAULT_TIMEOUT = 60
 
-# The requests send queue
+# Accepted types of the attributes of a request, shared by send(),
+# `POST /` and `htq load`. The timeout is stored as whole seconds.
+REQUEST_ATTRIBUTES = {
+    'url': (str,),
+    'method': (str,),
+    'data': (str,),
+    'headers': (dict,),
+    'id': (str, int),
+    'timeout': (int,),
+    'tenant': (str,),
+    'ttl': (int, float),
+    'deadline': (int,),
+}
+
+# The requests send queue of the default tenant
 REQ_SEND_QUEUE = 'htq:send'
 
+# Key prefix of the send queues of other tenants
+TENANT_QUEUE_PREFIX = 'htq:send:'
+
+# Hash of the weight of each tenant with queued requests
+TENANTS = 'htq:tenants'
+
+# Tenant of requests sent without one
+DEFAULT_TENANT = 'default'
+
+# Sorted set of the UUIDs of requests with a deadline by deadline
+DEADLINES = 'htq:deadlines'
+
+# Sorted set of the UUIDs of requests deferred by an open circuit by the
+# time they are put back on the queue
+DEFERRED = 'htq:deferred'
+
+# Sorted set of the UUIDs of completed requests by completion time
+COMPLETED = 'htq:completed'
+
+# Hash of the info published by each registered worker by worker id
+WORKERS = 'htq:workers'
+
+# Keys that exist while a worker is alive. They are set with a TTL that
+# each heartbeat extends
+HEARTBEAT_PREFIX = 'htq:heartbeats:'
+
+# Hashes of the UUIDs a worker took off the queue but has not finished
+IN_FLIGHT_PREFIX = 'htq:inflight:'
+
+# Seconds after the last heartbeat a worker is considered dead
+HEARTBEAT_TTL = 15
+
 # Requests by ID
 REQ_IDS = 'htq:ids'
 
+# The queue of cancel notices to send to the endpoints of running requests
+CANCEL_QUEUE = 'htq:cancel'
+
+# Maximum seconds to wait for the endpoint to accept a cancel notice
+CANCEL_TIMEOUT = 5
+
+# Number of attempts to deliver a cancel notice
+CANCEL_ATTEMPTS = 3
+
+# Seconds before the first retry of a cancel notice, doubled for each
+# further attempt
+CANCEL_BACKOFF = 1
+
+# Sorted set of the cancel notices waiting to be retried by due time
+CANCEL_RETRIES = 'htq:cancel:retries'
+
 # Key prefix of a hash that stores the requests
 REQ_PREFIX = 'htq:requests:'
 
 # Key prefix of a hash that stores the responses
 RESP_PREFIX = 'htq:responses:'
 
+# Key prefix of a list that stores the body of a response in chunks
+BODY_PREFIX = 'htq:bodies:'
+
+# Number of bytes read from the upstream response per chunk
+BODY_CHUNK_SIZE = 64 * 1024
+
+# Number of chunks of a body written to storage per round trip
+BODY_PIPELINE_CHUNKS = 16
+
+# Maximum number of bytes of a response body that are stored, the rest is
+# discarded and the response marked as truncated. Bodies are stored as
+# latin-1 text encoded as UTF-8, so bytes from 0x80 up take two bytes in
+# storage and a binary body may use up to twice this much memory.
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+# Key prefix of a hash that stores the histogram of a timing phase
+TIMING_PREFIX = 'htq:timings:'
+
+# Timing phases recorded for each response as the pair of timestamps
+# that bound them
+TIMING_PHASES = (
+    ('queue', 'enqueued', 'dequeued'),
+    ('claim', 'dequeued', 'claimed'),
+    ('first_byte', 'claimed', 'first_byte'),
+    ('download', 'first_byte', 'complete'),
+    ('store', 'complete', 'stored'),
+    ('total', 'enqueued', 'stored'),
+)
+
+# Upper bounds of the timing histogram buckets in milliseconds
+TIMING_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                  10000, 30000, 60000, 300000)
+
+# Key of a list of the most recent requests that were slow to handle
+SLOW_TASKS = 'htq:slow'
+
+# Number of slow requests kept
+SLOW_TASKS_LIMIT = 1000
+
+# Milliseconds from being dequeued to the response being stored above which
+# a request is recorded as slow, None to not record slow requests
+SLOW_THRESHOLD = None
+
 
 QUEUED = 'queued'
 CANCELED = 'canceled'
@@ -52,16 +192,137 @@ PENDING = 'pending'
 SUCCESS = 'success'
 TIMEOUT = 'timeout'
 ERROR = 'error'
+EXPIRED = 'expired'
 
 
 logger = logging.getLogger('htq')
 
 
+# Circuit breaker for the hosts requests are sent to
+breaker = CircuitBreaker()
+
+
+# Callbacks run around receive() and cancel() by event
+HOOKS = {
+    'before_receive': [],
+    'after_receive': [],
+    'before_cancel': [],
+    'after_cancel': [],
+}
+
+
+dequeued_total = metrics.counter(
+    'htq_dequeued_total', 'Number of requests dequeued for receiving.')
+
+in_flight = metrics.gauge(
+    'htq_in_flight', 'Number of requests being received.')
+
+upstream_seconds = metrics.histogram(
+    'htq_upstream_seconds', 'Latency of upstream requests.',
+    labels=('host', 'status'))
+
+watch_errors_total = metrics.counter(
+    'htq_watch_errors_total', 'Number of interrupted state changes.',
+    labels=('operation',))
+
+requeued_total = metrics.counter(
+    'htq_requeued_total', 'Number of requests requeued after an error.')
+
+breaker_rejected_total = metrics.counter(
+    'htq_breaker_rejected_total', 'Number of requests rejected by an open '
+    'circuit.', labels=('host',))
+
+breaker_opened_total = metrics.counter(
+    'htq_breaker_opened_total', 'Number of times a circuit opened.',
+    labels=('host',))
+
+slow_tasks_total = metrics.counter(
+    'htq_slow_tasks_total', 'Number of requests slower to handle than the '
+    'slow threshold.')
+
+expired_total = metrics.counter(
+    'htq_expired_total', 'Number of requests expired before being sent.')
+
+archived_total = metrics.counter(
+    'htq_archived_total', 'Number of completed requests archived.')
+
+truncated_total = metrics.counter(
+    'htq_truncated_total', 'Number of response bodies truncated at the '
+    'maximum size.')
+
+reaped_total = metrics.counter(
+    'htq_reaped_total', 'Number of requests requeued from dead workers.')
+
+cancel_notices_total = metrics.counter(
+    'htq_cancel_notices_total', 'Number of cancel notices sent by result.',
+    labels=('result',))
+
+
 def _timestamp():
     return int(time.time() * 1000)
 
 
+def _queue_key(tenant):
+    "Returns the key of the send queue of a tenant."
+    if not tenant or tenant == DEFAULT_TENANT:
+        return REQ_SEND_QUEUE
+
+    return TENANT_QUEUE_PREFIX + tenant
+
+
+# Version tag of the compact encoding and the fields packed in its blob,
+# in order. The status, tenant and version of requests are kept as hash
+# fields so they can be read and updated on their own.
+COMPACT_VERSION = '1'
+
+COMPACT_REQUEST_FIELDS = ('uuid', 'time', 'url', 'method', 'data', 'headers',
+                          'timeout', 'id', 'deadline')
+
+COMPACT_RESPONSE_FIELDS = ('uuid', 'status', 'time', 'elapsed', 'code',
+                           'reason', 'data', 'headers', 'message', 'timing',
+                           'size', 'charset', 'truncated')
+
+_compact = False
+
+
+def set_compact(enabled=True):
+    """Sets whether requests and responses are stored in the compact
+    encoding, a single msgpack blob per request or response. Requires
+    msgpack. Both encodings are always readable.
+    """
+    global _compact
+
+    if enabled:
+        encoding.require()
+
+    _compact = enabled
+
+
+def _unpack(r, fields):
+    "Returns the fields of a hash in the compact encoding."
+    if r.pop('_v') != COMPACT_VERSION:
+        raise ValueError('unknown encoding version')
+
+    return dict(zip(fields, encoding.unpack_text(r.pop('_blob'))))
+
+
+def _set_status(p, key, status):
+    "Adds the commands that change the status of a request to a pipeline."
+    p.hset(key, 'status', status)
+    p.hincrby(key, 'version', 1)
+
+
 def _encode_request(r):
+    if _compact:
+        return {
+            '_v': COMPACT_VERSION,
+            '_blob': encoding.pack_text([r.get(f)
+                                         for f in COMPACT_REQUEST_FIELDS]),
+            'status': r['status'],
+            'tenant': r['tenant'],
+            'version': r['version'],
+        }
+
     r = r.copy()
 
     if 'headers' in r:
@@ -71,6 +332,9 @@ def _encode_request(r):
     if 'data' in r and r['data'] is None:
         r.pop('data')
 
+    if 'deadline' in r and r['deadline'] is None:
+        r.pop('deadline')
+
     return r
 
 
@@ -78,6 +342,17 @@ def _decode_request(r):
     if not r:
         return
 
+    # Requests queued before versions were tracked
+    r['version'] = int(r.get('version', 0))
+
+    if '_v' in r:
+        r.update(_unpack(r, COMPACT_REQUEST_FIELDS))
+
+        if r['deadline'] is None:
+            r.pop('deadline')
+
+        return r
+
     if 'data' not in r:
         r['data'] = None
 
@@ -85,15 +360,38 @@ def _decode_request(r):
     r['time'] = int(r['time'])
     r['headers'] = json.loads(r['headers'])
 
+    # Requests queued before tenants were supported
+    r.setdefault('tenant', DEFAULT_TENANT)
+
+    if 'deadline' in r:
+        r['deadline'] = int(r['deadline'])
+
     return r
 
 
 def _encode_response(r):
+    if _compact:
+        return {
+            '_v': COMPACT_VERSION,
+            '_blob': encoding.pack_text([r.get(f)
+                                         for f in COMPACT_RESPONSE_FIELDS]),
+        }
+
     r = r.copy()
 
     if 'headers' in r:
         r['headers'] = json.dumps(r['headers'])
 
+    if 'timing' in r:
+        r['timing'] = json.dumps(r['timing'])
+
+    if 'truncated' in r:
+        r['truncated'] = int(r['truncated'])
+
+    # Remove an unknown charset so it is not stringified as 'None'
+    if 'charset' in r and r['charset'] is None:
+        r.pop('charset')
+
     return r
 
 
@@ -101,19 +399,220 @@ def _decode_response(r):
     if not r:
         return
 
+    if '_v' in r:
+        return {k: v for k, v in _unpack(r, COMPACT_RESPONSE_FIELDS).items()
+                if v is not None}
+
     r['time'] = int(r['time'])
 
+    if 'timing' in r:
+        r['timing'] = json.loads(r['timing'])
+
     if r['status'] == SUCCESS:
         r['code'] = int(r['code'])
         r['elapsed'] = float(r['elapsed'])
         r['headers'] = json.loads(r['headers'])
 
+    # Responses stored before bodies were streamed have the data inline
+    if 'size' in r:
+        r['size'] = int(r['size'])
+        r['truncated'] = bool(int(r['truncated']))
+
     return r
 
 
-def send(url, method=None, data=None, headers=None, id=None, timeout=None):
-    "Enqueues an HTTP request."
-    client = get_redis_client()
+def _store_body(client, key, rp):
+    """Streams the body of an upstream response into a list of chunks so
+    it is never held in memory as a whole.
+
+    Chunks are stored as latin-1 text which maps each byte to one code
+    point, and are written BODY_PIPELINE_CHUNKS at a time. Reading stops
+    at MAX_BODY_SIZE. Returns the number of bytes stored and whether the
+    body was truncated.
+    """
+    size = 0
+    truncated = False
+
+    try:
+        with client.pipeline(transaction=False) as p:
+            for chunk in rp.iter_content(BODY_CHUNK_SIZE):
+                truncated = size + len(chunk) > MAX_BODY_SIZE
+
+                if truncated:
+                    chunk = chunk[:MAX_BODY_SIZE - size]
+
+                if chunk:
+                    p.rpush(key, chunk.decode('latin1'))
+                    size += len(chunk)
+
+                if truncated:
+                    break
+
+                if len(p) >= BODY_PIPELINE_CHUNKS:
+                    p.execute()
+
+            p.execute()
+    finally:
+        rp.close()
+
+    return size, truncated
+
+
+def _join_body(chunks):
+    "Returns the bytes of a body stored by `_store_body`."
+    return ''.join(chunks).encode('latin1')
+
+
+def _set_data(resp, chunks):
+    """Sets the data of a response to the text of its stored body, decoded
+    with the charset of the upstream response. UTF-8 is assumed if the
+    charset is unknown.
+    """
+    if not resp or 'size' not in resp:
+        return resp
+
+    charset = resp.get('charset') or 'utf8'
+
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = 'utf8'
+
+    resp['data'] = _join_body(chunks).decode(charset, 'replace')
+
+    return resp
+
+
+def _timing_bucket(ms):
+    "Returns the histogram bucket for a duration in milliseconds."
+    for bound in TIMING_BUCKETS:
+        if ms <= bound:
+            return str(bound)
+
+    return '+inf'
+
+
+def _phases(timing):
+    "Returns the duration of each phase of a response's timing."
+    durations = {}
+
+    for phase, start, end in TIMING_PHASES:
+        if timing.get(start) is None or timing.get(end) is None:
+            continue
+
+        durations[phase] = timing[end] - timing[start]
+
+    return durations
+
+
+def _record_timing(p, timing):
+    "Adds the phases of a response's timing to the histograms."
+    for phase, ms in _phases(timing).items():
+        p.hincrby(TIMING_PREFIX + phase, _timing_bucket(ms), 1)
+
+
+def _record_slow(p, req, resp, timing):
+    """Adds a request to the slow requests if it took longer than
+    SLOW_THRESHOLD to handle.
+    """
+    if SLOW_THRESHOLD is None:
+        return
+
+    duration = timing['stored'] - timing['dequeued']
+
+    if duration <= SLOW_THRESHOLD:
+        return
+
+    logger.warning('[{}] slow request, handled in {}ms'
+                   .format(req['uuid'], duration))
+    slow_tasks_total.inc()
+
+    p.lpush(SLOW_TASKS, json.dumps({
+        'uuid': req['uuid'],
+        'url': req['url'],
+        'method': req['method'],
+        'status': resp['status'],
+        'code': resp.get('code'),
+        'size': resp.get('size'),
+        'time': timing['dequeued'],
+        'duration': duration,
+        'phases': _phases(timing),
+    }))
+    p.ltrim(SLOW_TASKS, 0, SLOW_TASKS_LIMIT - 1)
+
+
+def add_hook(event, func):
+    """Registers a callback for an event.
+
+    The events are `before_receive` and `before_cancel`, called with the
+    request UUID, and `after_receive` and `after_cancel`, called with the
+    UUID and the return value of receive() or cancel(). Exceptions raised
+    by callbacks are logged and ignored.
+    """
+    if event not in HOOKS:
+        raise ValueError('unknown hook event "{}"'.format(event))
+
+    HOOKS[event].append(func)
+
+
+def remove_hook(event, func):
+    "Removes a callback registered with add_hook."
+    HOOKS[event].remove(func)
+
+
+def _run_hooks(event, *args):
+    for func in HOOKS[event]:
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('error in {} hook'.format(event))
+
+
+def _is_instance(value, types):
+    # bool is a subclass of int
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    return _is_instance(value, (int, float))
+
+
+def _check_request(attrs):
+    """Raises ValueError if the attributes of a request, a dict of send()
+    arguments, are invalid.
+    """
+    if not attrs.get('url'):
+        raise ValueError('url is required')
+
+    for key, types in REQUEST_ATTRIBUTES.items():
+        value = attrs.get(key)
+
+        if value is not None and not _is_instance(value, types):
+            raise ValueError('{} must be of type {}'.format(
+                key, ' or '.join(t.__name__ for t in types)))
+
+    if attrs.get('tenant') == '':
+        raise ValueError('tenant must not be empty')
+
+
+def _build_request(url, method=None, data=None, headers=None, id=None,
+                   timeout=None, tenant=None, ttl=None, deadline=None):
+    # Checked before anything is written since invalid values would fail
+    # part way through queueing or when the request is received
+    _check_request({
+        'url': url,
+        'method': method,
+        'data': data,
+        'headers': headers,
+        'id': id,
+        'timeout': timeout,
+        'tenant': tenant,
+        'ttl': ttl,
+        'deadline': deadline,
+    })
+
+    if id is not None:
+        id = str(id)
 
     if not method:
         if data is None:
@@ -129,46 +628,157 @@ def send(url, method=None, data=None, headers=None, id=None, timeout=None):
     if not headers:
         headers = {}
 
-    req = {
+    if tenant is None:
+        tenant = DEFAULT_TENANT
+
+    now = _timestamp()
+
+    if ttl is not None:
+        ttl_deadline = now + int(ttl * 1000)
+
+        if deadline is None or ttl_deadline < deadline:
+            deadline = ttl_deadline
+
+    return {
         'uuid': uuid,
         'status': QUEUED,
-        'time': _timestamp(),
+        'version': 1,
+        'time': now,
         'url': url,
         'method': method,
         'data': data,
         'headers': headers,
         'timeout': timeout,
         'id': id,
+        'tenant': tenant,
+        'deadline': deadline,
     }
 
+
+def _queue_request(p, req):
+    "Adds the commands that queue a request to a pipeline."
+    uuid = req['uuid']
+
+    if req['id']:
+        p.hset(REQ_IDS, req['id'], uuid)
+
+    if req['deadline'] is not None:
+        p.zadd(DEADLINES, req['deadline'], uuid)
+
+    p.hsetnx(TENANTS, req['tenant'], 1)
+    p.lpush(_queue_key(req['tenant']), uuid)
+    p.hmset(REQ_PREFIX + uuid, _encode_request(req))
+
+
+def send(url, method=None, data=None, headers=None, id=None, timeout=None,
+         tenant=None, ttl=None, deadline=None):
+    """Enqueues an HTTP request.
+
+    Requests are queued per tenant and workers take turns between the
+    tenants' queues, so a tenant with a large backlog does not hold up the
+    requests of others.
+
+    A request that has not been sent by its deadline, a timestamp in
+    milliseconds, or within `ttl` seconds of being queued is not sent and
+    its status is set to expired.
+
+    Raises ValueError if the url is missing or an argument is not of a
+    type in REQUEST_ATTRIBUTES, e.g. `ttl` is not a number or `tenant` is
+    an empty string.
+    """
+    client = get_redis_client()
+
+    req = _build_request(url=url,
+                         method=method,
+                         data=data,
+                         headers=headers,
+                         id=id,
+                         timeout=timeout,
+                         tenant=tenant,
+                         ttl=ttl,
+                         deadline=deadline)
+
     # If an ID is supplied, cancel the existing request if one
     # exists and update the id->uuid map
-    if id:
-        _uuid = client.hget(REQ_IDS, id)
+    if req['id']:
+        _uuid = client.hget(REQ_IDS, req['id'])
 
         if _uuid:
             cancel(_uuid)
 
     with client.pipeline() as p:
         p.multi()
+        _queue_request(p, req)
+        p.execute()
+
+    logger.debug('[{}] queued request'.format(req['uuid']))
+
+    return req
+
+
+def send_many(reqs):
+    """Enqueues a batch of HTTP requests in a single pipeline.
 
-        if id:
-            p.hset(REQ_IDS, id, uuid)
+    `reqs` is a sequence of dicts of send() arguments. As with send(),
+    existing requests with the same `id` are canceled, including earlier
+    ones in the batch. Returns the queued requests.
+    """
+    client = get_redis_client()
+
+    reqs = [_build_request(**kwargs) for kwargs in reqs]
+
+    ids = [req['id'] for req in reqs if req['id']]
+
+    if ids:
+        for _uuid in client.hmget(REQ_IDS, ids):
+            if _uuid:
+                cancel(_uuid)
+
+        # The last request with an ID supersedes earlier ones in the batch
+        latest = {}
+
+        for req in reqs:
+            if req['id']:
+                if req['id'] in latest:
+                    latest[req['id']]['status'] = CANCELED
+
+                latest[req['id']] = req
+
+    with client.pipeline(transaction=False) as p:
+        for req in reqs:
+            _queue_request(p, req)
 
-        p.lpush(REQ_SEND_QUEUE, uuid)
-        p.hmset(REQ_PREFIX + uuid, _encode_request(req))
         p.execute()
 
-    logger.debug('[{}] queued request'.format(uuid))
+    logger.debug('queued {} requests'.format(len(reqs)))
+
+    return reqs
+
+
+def _tenant_keys(client):
+    "Returns the send queue key of each tenant."
+    keys = {DEFAULT_TENANT: REQ_SEND_QUEUE}
+
+    for tenant in client.hgetall(TENANTS):
+        keys[tenant] = _queue_key(tenant)
+
+    return keys
 
-    return req
 
+def pop(tenant=None):
+    """Pops the next request UUID off the queue for processing.
 
-def pop():
-    "Pops the next request UUID off the queue for processing."
+    If no tenant is passed, the UUID is popped off the first tenant queue
+    with requests.
+    """
     client = get_redis_client()
 
-    return client.brpop(REQ_SEND_QUEUE)[1]
+    if tenant:
+        keys = [_queue_key(tenant)]
+    else:
+        keys = sorted(_tenant_keys(client).values())
+
+    return client.brpop(keys)[1]
 
 
 def push(uuid):
@@ -179,54 +789,228 @@ def push(uuid):
     """
     client = get_redis_client()
 
-    client.lpush(REQ_SEND_QUEUE, uuid)
+    tenant = client.hget(REQ_PREFIX + uuid, 'tenant')
 
+    client.lpush(_queue_key(tenant), uuid)
 
-def queued():
-    "Returns all queued requests."
+
+def queued(tenant=None):
+    "Returns all queued requests, optionally of a single tenant."
     client = get_redis_client()
 
-    stop = client.llen(REQ_SEND_QUEUE)
+    if tenant:
+        keys = [_queue_key(tenant)]
+    else:
+        keys = sorted(_tenant_keys(client).values())
 
     reqs = []
 
-    # Get the full range
-    for uuid in client.lrange(REQ_SEND_QUEUE, 0, stop):
-        reqs.append(_decode_request(client.hgetall(REQ_PREFIX + uuid)))
+    for key in keys:
+        stop = client.llen(key)
+
+        # Get the full range
+        for uuid in client.lrange(key, 0, stop):
+            reqs.append(_decode_request(client.hgetall(REQ_PREFIX + uuid)))
 
     return reqs
 
 
-def size():
-    "Returns the size of the request queue."
+def size(tenant=None):
+    """Returns the size of the request queue.
+
+    If no tenant is passed, this is the total size of the tenant queues.
+    """
+    client = get_redis_client()
+
+    if tenant:
+        return client.llen(_queue_key(tenant))
+
+    return sum(tenants().values())
+
+
+queue_depth = metrics.gauge(
+    'htq_queue_depth', 'Number of queued requests.', func=size)
+
+
+def tenants():
+    "Returns the size of the request queue of each tenant."
+    client = get_redis_client()
+
+    keys = _tenant_keys(client)
+
+    with client.pipeline() as p:
+        for tenant in keys:
+            p.llen(keys[tenant])
+
+        sizes = p.execute()
+
+    return dict(zip(keys, sizes))
+
+
+def _valid_weight(weight):
+    return _is_number(weight) and 0 < weight < float('inf')
+
+
+def set_weight(tenant, weight):
+    """Sets the weight of a tenant.
+
+    Each turn, workers pop requests off a tenant's queue in proportion to
+    its weight, which defaults to 1. Raises ValueError unless the weight is
+    a positive number.
+    """
+    if not _valid_weight(weight):
+        raise ValueError('weight must be a positive number')
+
     client = get_redis_client()
 
-    return client.llen(REQ_SEND_QUEUE)
+    client.hset(TENANTS, tenant or DEFAULT_TENANT, weight)
+
+
+def _archived(uuid):
+    "Returns the archived record of a request, if any."
+    store = get_archive()
+
+    if store is not None:
+        return store.get(uuid)
+
+
+def _archived_records(uuids):
+    "Returns the archived records of the requests by UUID."
+    records = {}
+
+    if get_archive() is None:
+        return records
+
+    for uuid in uuids:
+        record = _archived(uuid)
+
+        if record:
+            records[uuid] = record
+
+    return records
+
+
+def _archived_field(uuid, field):
+    "Returns the archived request or response of a request, if any."
+    record = _archived(uuid)
+
+    if record:
+        return record[field]
+
+
+def _archived_status(record):
+    if record and record['request']:
+        return record['request']['status']
 
 
 def request(uuid):
     "Get a request by UUID."
     client = get_redis_client()
 
-    req = client.hgetall(REQ_PREFIX + uuid)
+    req = _decode_request(client.hgetall(REQ_PREFIX + uuid))
 
-    return _decode_request(req)
+    if req is None:
+        req = _archived_field(uuid, 'request')
+
+    return req
 
 
 def status(uuid):
     "Get the request status by UUID."
     client = get_redis_client()
 
-    return client.hget(REQ_PREFIX + uuid, 'status')
+    status = client.hget(REQ_PREFIX + uuid, 'status')
+
+    if status is None:
+        status = _archived_status(_archived(uuid))
+
+    return status
+
+
+def version(uuid):
+    """Gets the version of a request by UUID. The version is incremented
+    each time the status or response of the request changes.
+    """
+    client = get_redis_client()
+
+    status, version = client.hmget(REQ_PREFIX + uuid, 'status', 'version')
+
+    if status is None:
+        record = _archived(uuid)
+
+        if record and record['request']:
+            return record['request'].get('version', 0)
+
+        return
+
+    return int(version or 0)
+
+
+def _complete(status):
+    return status is not None and status not in {QUEUED, PENDING}
+
+
+def _unknown(uuids, statuses):
+    "Returns the UUIDs of the requests without a stored status."
+    return [uuid for uuid, _status in zip(uuids, statuses) if _status is None]
+
+
+def _read_statuses(p, uuids):
+    "Adds the commands reading the statuses of requests to a pipeline."
+    for uuid in uuids:
+        p.hget(REQ_PREFIX + uuid, 'status')
+
+
+def _status_results(uuids, results, records, completed):
+    """Returns the statuses of requests from the results of the pipeline
+    of `_read_statuses` and the archived `records` of the unknown requests.
+    """
+    found = {}
+
+    for uuid, _status in zip(uuids, results):
+        if _status is None:
+            _status = _archived_status(records.get(uuid))
+
+        if _status is None or completed and not _complete(_status):
+            continue
+
+        found[uuid] = _status
+
+    return found
+
+
+def statuses(uuids, completed=False):
+    """Gets the statuses of requests by UUID in one round trip.
+
+    Returns a dict of UUID to status of the known requests. If `completed`
+    is true, requests that are queued or pending are left out.
+    """
+    client = get_redis_client()
+
+    with client.pipeline(transaction=False) as p:
+        _read_statuses(p, uuids)
+        results = p.execute()
+
+    records = _archived_records(_unknown(uuids, results))
+
+    return _status_results(uuids, results, records, completed)
 
 
 def cancel(uuid):
     """Cancels a request.
 
     This will mark the status as 'canceled' on the request if it has not yet
-    be completed. If the request is running, a DELETE request will be sent to
-    the URL to cancel the operation.
+    be completed. If the request is running, a cancel notice is queued for a
+    worker to send a DELETE request to the URL to cancel the operation.
     """
+    _run_hooks('before_cancel', uuid)
+    ok = _cancel(uuid)
+    _run_hooks('after_cancel', uuid, ok)
+
+    return ok
+
+
+def _cancel(uuid):
     client = get_redis_client()
 
     key = REQ_PREFIX + uuid
@@ -244,13 +1028,14 @@ def cancel(uuid):
         logger.debug('[{}] request already canceled'.format(uuid))
         return True
 
-    if req['status'] in {SUCCESS, TIMEOUT, ERROR}:
+    if req['status'] in {SUCCESS, TIMEOUT, ERROR, EXPIRED}:
         logger.debug('[{}] canceling completed request'.format(uuid))
 
         with client.pipeline() as p:
             p.multi()
-            p.hset(key, 'status', 'canceled')
-            p.delete(RESP_PREFIX + uuid)
+            _set_status(p, key, CANCELED)
+            p.delete(RESP_PREFIX + uuid, BODY_PREFIX + uuid)
+            p.zadd(COMPLETED, _timestamp(), uuid)
             p.execute()
 
         return True
@@ -259,66 +1044,701 @@ def cancel(uuid):
     try:
         with client.pipeline() as p:
             p.watch(key)
-            p.hset(key, 'status', 'canceled')
-            p.execute()
-    except redis.WatchError:
-        logger.exception('[{}] cancel interrupted, retrying'.format(uuid))
+
+            # Ensure the status did not change since it was read
+            if p.hget(key, 'status') != req['status']:
+                raise redis.WatchError
+
+            p.multi()
+            _set_status(p, key, CANCELED)
+
+            # Canceled requests are archived like completed ones
+            p.zadd(COMPLETED, _timestamp(), uuid)
+
+            # The req is already running, so queue a notice to send a
+            # delete request to the endpoint
+            if req['status'] == PENDING:
+                p.lpush(CANCEL_QUEUE, json.dumps({
+                    'uuid': uuid,
+                    'attempt': 1,
+                }))
+
+            p.execute()
+    except redis.WatchError:
+        watch_errors_total.inc(operation='cancel')
+        logger.debug('[{}] cancel interrupted, retrying'.format(uuid))
         # Retry cancel since the status most likely changed
-        return cancel(uuid)
+        return _cancel(uuid)
 
     # If it was only queued, just return since it will skipped
     # when it is received
     if req['status'] == QUEUED:
         logger.debug('[{}] canceled request'.format(uuid))
-        return True
+    else:
+        logger.debug('[{}] queued cancel notice'.format(uuid))
+
+    return True
+
+
+def pop_cancel():
+    "Pops the next cancel notice off the queue for sending."
+    client = get_redis_client()
+
+    requeue_cancel_notices()
+
+    return json.loads(client.brpop(CANCEL_QUEUE)[1])
+
+
+def requeue_cancel_notices(limit=1000):
+    """Puts cancel notices whose retry is due back on the queue.
+
+    Up to `limit` notices are handled per call. Returns the number of
+    notices requeued.
+    """
+    client = get_redis_client()
+
+    notices = client.zrangebyscore(CANCEL_RETRIES, '-inf', _timestamp(),
+                                   start=0, num=limit)
+
+    if not notices:
+        return 0
+
+    with client.pipeline(transaction=False) as p:
+        for notice in notices:
+            p.zrem(CANCEL_RETRIES, notice)
+
+        removed = p.execute()
+
+    # Only the caller that removed a notice requeues it
+    due = [notice for notice, n in zip(notices, removed) if n]
+
+    if due:
+        client.lpush(CANCEL_QUEUE, *due)
+
+    return len(due)
+
+
+def receive_cancel(notice):
+    """Sends the DELETE request of a cancel notice.
+
+    The endpoint may or may not accept the request. Connection errors,
+    timeouts and server errors are retried until CANCEL_ATTEMPTS is reached,
+    waiting CANCEL_BACKOFF seconds before the first retry and twice as long
+    before each next one. Returns true if the endpoint accepted the
+    request.
+    """
+    client = get_redis_client()
+
+    uuid = notice['uuid']
+    req = _decode_request(client.hgetall(REQ_PREFIX + uuid))
+
+    if not req:
+        logger.debug('[{}] unknown request'.format(uuid))
+        return False
 
-    # Send a DELETE request that may or may not cancel
-    # the previous request
     logger.debug('[{}] sending delete request...'.format(uuid))
 
     try:
-        # The req was already running, so send a delete request to
-        # the endpoint. It may or may not accept the request
         rp = requests.request(url=req['url'],
                               method='delete',
                               headers=req['headers'],
-                              timeout=req['timeout'])
-
+                              timeout=min(req['timeout'], CANCEL_TIMEOUT))
+    except requests.RequestException:
+        logger.debug('[{}] error sending delete request'.format(uuid))
+        retry = True
+    else:
         if 200 <= rp.status_code < 300:
             logger.debug('[{}] successful delete request'.format(uuid))
-        else:
-            logger.debug('[{}] error handling delete request'.format(uuid))
-    except Exception:
-        logger.debug('[{}] error sending delete request'.format(uuid))
+            cancel_notices_total.inc(result='success')
+            return True
 
-    return True
+        logger.debug('[{}] error handling delete request'.format(uuid))
+        retry = rp.status_code >= 500
+
+    if not retry:
+        cancel_notices_total.inc(result='rejected')
+    elif notice['attempt'] < CANCEL_ATTEMPTS:
+        cancel_notices_total.inc(result='retry')
+
+        delay = CANCEL_BACKOFF * 2 ** (notice['attempt'] - 1)
+
+        client.zadd(CANCEL_RETRIES, _timestamp() + int(delay * 1000),
+                    json.dumps({
+                        'uuid': uuid,
+                        'attempt': notice['attempt'] + 1,
+                    }))
+    else:
+        cancel_notices_total.inc(result='failed')
+        logger.debug('[{}] giving up on delete request'.format(uuid))
+
+    return False
+
+
+def _read_response(p, uuid):
+    "Adds the commands reading a response and its body to a pipeline."
+    p.hgetall(RESP_PREFIX + uuid)
+    p.lrange(BODY_PREFIX + uuid, 0, -1)
 
 
 def response(uuid):
-    "Gets a response by UUID."
+    "Gets a response by UUID, falling back to the archive."
     client = get_redis_client()
 
-    return _decode_response(client.hgetall(RESP_PREFIX + uuid))
+    with client.pipeline(transaction=False) as p:
+        _read_response(p, uuid)
+        resp, chunks = p.execute()
+
+    resp = _set_data(_decode_response(resp), chunks)
+
+    if resp is None:
+        resp = _archived_field(uuid, 'response')
+
+    return resp
+
+
+def body(uuid):
+    """Gets the body of a response as the bytes received from the upstream
+    endpoint. Returns None if there is no stored body.
+    """
+    client = get_redis_client()
+
+    with client.pipeline(transaction=False) as p:
+        _read_response(p, uuid)
+        resp, chunks = p.execute()
+
+    resp = _decode_response(resp)
+
+    if not resp:
+        return _archived_body(uuid)
+
+    if 'size' in resp:
+        return _join_body(chunks)
+
+    # Stored before bodies were streamed
+    if resp.get('data') is not None:
+        return resp['data'].encode('utf8')
+
+
+def _archived_body(uuid):
+    "Returns the bytes of the body of an archived response, if any."
+    record = _archived(uuid)
+
+    if not record:
+        return
+
+    if record.get('body') is not None:
+        return base64.b64decode(record['body'])
+
+    # Archived before the bytes were kept
+    resp = record['response']
+
+    if resp and resp.get('data') is not None:
+        return resp['data'].encode('utf8')
+
+
+def _read_responses(p, uuids):
+    """Adds the commands reading the statuses and responses of requests to
+    a pipeline.
+    """
+    for uuid in uuids:
+        p.hget(REQ_PREFIX + uuid, 'status')
+        _read_response(p, uuid)
+
+
+def _response_results(uuids, results, records, completed):
+    """Returns the responses of requests from the results of the pipeline
+    of `_read_responses` and the archived `records` of the unknown
+    requests.
+    """
+    found = {}
+
+    for i, uuid in enumerate(uuids):
+        _status, resp, chunks = results[i * 3:i * 3 + 3]
+        resp = _set_data(_decode_response(resp), chunks)
+
+        if _status is None:
+            record = records.get(uuid)
+            _status = _archived_status(record)
+
+            if _status is not None:
+                resp = record['response']
+
+        if _status is None or completed and not _complete(_status):
+            continue
+
+        found[uuid] = resp
+
+    return found
+
+
+def responses(uuids, completed=False):
+    """Gets the responses of requests by UUID in one round trip.
+
+    Returns a dict of UUID to response of the known requests, where the
+    response is None if the request has not completed or has no response.
+    If `completed` is true, requests that are queued or pending are left
+    out.
+    """
+    client = get_redis_client()
+
+    with client.pipeline(transaction=False) as p:
+        _read_responses(p, uuids)
+        results = p.execute()
+
+    records = _archived_records(_unknown(uuids, results[::3]))
+
+    return _response_results(uuids, results, records, completed)
 
 
 def purge(uuid):
     "Purge a response."
     client = get_redis_client()
 
-    return client.delete(RESP_PREFIX + uuid)
+    with client.pipeline(transaction=False) as p:
+        p.delete(RESP_PREFIX + uuid)
+        p.delete(BODY_PREFIX + uuid)
+        p.zrem(COMPLETED, uuid)
+
+        deleted = p.execute()[0]
+
+    # The response of the request changed
+    if deleted and client.exists(REQ_PREFIX + uuid):
+        client.hincrby(REQ_PREFIX + uuid, 'version', 1)
+
+    return deleted
+
+
+def timings():
+    """Returns the histograms of the timing phases of received responses.
+
+    Each phase maps the upper bound of a bucket in milliseconds to the
+    number of responses whose phase fell in the bucket.
+    """
+    client = get_redis_client()
+
+    with client.pipeline() as p:
+        for phase, start, end in TIMING_PHASES:
+            p.hgetall(TIMING_PREFIX + phase)
+
+        results = p.execute()
+
+    hists = {}
+
+    for (phase, start, end), hist in zip(TIMING_PHASES, results):
+        hists[phase] = {b: int(n) for b, n in hist.items()}
+
+    return hists
+
+
+def slow_tasks(limit=100):
+    """Returns the most recent requests that took longer than
+    SLOW_THRESHOLD to handle, newest first, with the duration of each phase
+    of their timing in milliseconds.
+    """
+    client = get_redis_client()
+
+    return [json.loads(t) for t in client.lrange(SLOW_TASKS, 0, limit - 1)]
+
+
+def sweep(limit=1000):
+    """Removes queued requests that are past their deadline from the queue
+    and sets their status to expired.
+
+    Up to `limit` requests are handled per call. Returns the number of
+    requests that expired.
+    """
+    client = get_redis_client()
+
+    uuids = client.zrangebyscore(DEADLINES, '-inf', _timestamp(),
+                                 start=0, num=limit)
+
+    if not uuids:
+        return 0
+
+    with client.pipeline(transaction=False) as p:
+        for uuid in uuids:
+            p.hmget(REQ_PREFIX + uuid, 'status', 'tenant')
+
+        states = p.execute()
+
+    queued = [(uuid, tenant) for uuid, (status, tenant) in zip(uuids, states)
+              if status == QUEUED]
+
+    # Expired requests are the oldest, so they are removed starting from
+    # the end of the queue the workers pop from. A request is only expired
+    # if it was still in the queue, otherwise a worker already has it.
+    with client.pipeline(transaction=False) as p:
+        for uuid, tenant in queued:
+            p.lrem(_queue_key(tenant), -1, uuid)
+
+        removed = p.execute()
+
+    expired = [uuid for (uuid, _), n in zip(queued, removed) if n]
+
+    now = _timestamp()
+
+    with client.pipeline(transaction=False) as p:
+        for uuid in expired:
+            _set_status(p, REQ_PREFIX + uuid, EXPIRED)
+            p.zadd(COMPLETED, now, uuid)
+
+        p.zrem(DEADLINES, *uuids)
+        p.execute()
+
+    if expired:
+        expired_total.inc(len(expired))
+        logger.debug('swept {} expired requests'.format(len(expired)))
+
+    return len(expired)
+
+
+def requeue_deferred(limit=1000):
+    """Puts requests deferred by an open circuit back on the front of the
+    queue once the circuit lets probes through.
+
+    Up to `limit` requests are handled per call. Returns the number of
+    requests requeued.
+    """
+    client = get_redis_client()
+
+    uuids = client.zrangebyscore(DEFERRED, '-inf', _timestamp(),
+                                 start=0, num=limit)
+
+    if not uuids:
+        return 0
+
+    with client.pipeline(transaction=False) as p:
+        for uuid in uuids:
+            p.zrem(DEFERRED, uuid)
+            p.hget(REQ_PREFIX + uuid, 'tenant')
+
+        results = p.execute()
+
+    # Only the caller that removed a request requeues it
+    due = [(uuid, tenant) for uuid, removed, tenant
+           in zip(uuids, results[::2], results[1::2]) if removed and tenant]
+
+    with client.pipeline(transaction=False) as p:
+        for uuid, tenant in due:
+            p.rpush(_queue_key(tenant), uuid)
+
+        p.execute()
+
+    if due:
+        logger.debug('requeued {} deferred requests'.format(len(due)))
+
+    return len(due)
+
+
+def archive(age, limit=1000):
+    """Moves requests that completed more than `age` seconds ago and their
+    responses from storage to the archive.
+
+    Up to `limit` requests are handled per call. Returns the number of
+    requests archived.
+    """
+    store = get_archive()
+
+    if store is None:
+        raise ValueError('no archive is configured')
+
+    client = get_redis_client()
+
+    uuids = client.zrangebyscore(COMPLETED, '-inf',
+                                 _timestamp() - int(age * 1000),
+                                 start=0, num=limit)
+
+    if not uuids:
+        return 0
+
+    with client.pipeline(transaction=False) as p:
+        for uuid in uuids:
+            p.hgetall(REQ_PREFIX + uuid)
+            p.hgetall(RESP_PREFIX + uuid)
+            p.lrange(BODY_PREFIX + uuid, 0, -1)
+
+        results = p.execute()
+
+    records = []
+
+    for i, uuid in enumerate(uuids):
+        req = _decode_request(results[i * 3])
+        chunks = results[i * 3 + 2]
+        resp = _set_data(_decode_response(results[i * 3 + 1]), chunks)
+
+        # Purged since it completed
+        if req is None and resp is None:
+            continue
+
+        # The data is decoded text, the bytes are kept for `body`
+        body = None
+
+        if resp and 'size' in resp:
+            body = base64.b64encode(_join_body(chunks)).decode('ascii')
+
+        records.append({
+            'uuid': uuid,
+            'request': req,
+            'response': resp,
+            'body': body,
+        })
+
+    # Removed from storage only once durably archived
+    store.write(records)
+
+    ids = [(r['request']['id'], r['uuid']) for r in records
+           if r['request'] and r['request'].get('id')]
+
+    if ids:
+        current = client.hmget(REQ_IDS, [id for id, _ in ids])
+    else:
+        current = []
+
+    with client.pipeline(transaction=False) as p:
+        for r in records:
+            p.delete(REQ_PREFIX + r['uuid'], RESP_PREFIX + r['uuid'],
+                     BODY_PREFIX + r['uuid'])
+
+        # Unless the id was reused by a later request
+        for (id, uuid), _uuid in zip(ids, current):
+            if _uuid == uuid:
+                p.hdel(REQ_IDS, id)
+
+        p.zrem(COMPLETED, *uuids)
+        p.execute()
+
+    archived_total.inc(len(records))
+    logger.debug('archived {} requests'.format(len(records)))
+
+    return len(records)
+
+
+def register_worker(info=None, ttl=HEARTBEAT_TTL):
+    """Registers a worker and returns its id. `info` is a dict of details
+    about the worker published with its heartbeats.
+    """
+    worker_id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                  uuid4().hex[:8])
+
+    heartbeat(worker_id, info, ttl=ttl)
+
+    return worker_id
+
+
+def heartbeat(worker_id, info=None, ttl=HEARTBEAT_TTL):
+    "Marks a worker as alive for `ttl` seconds and publishes its info."
+    client = get_redis_client()
+
+    info = dict(info or {})
+    info['id'] = worker_id
+    info['heartbeat'] = _timestamp()
+
+    with client.pipeline(transaction=False) as p:
+        p.hset(WORKERS, worker_id, json.dumps(info))
+        p.set(HEARTBEAT_PREFIX + worker_id, info['heartbeat'],
+              px=int(ttl * 1000))
+        p.execute()
+
+
+def claim(worker_id, uuids, dequeued=None):
+    """Records that a worker took requests off the queue. `uuids` is a
+    UUID or a list of UUIDs.
+    """
+    client = get_redis_client()
+
+    if isinstance(uuids, str):
+        uuids = [uuids]
+
+    dequeued = dequeued or _timestamp()
+
+    client.hmset(IN_FLIGHT_PREFIX + worker_id,
+                 {uuid: dequeued for uuid in uuids})
+
+
+def release(worker_id, uuid):
+    "Records that a worker is done with a request."
+    client = get_redis_client()
+
+    client.hdel(IN_FLIGHT_PREFIX + worker_id, uuid)
+
+
+def unregister_worker(worker_id):
+    """Removes a worker from the registry, requeuing the requests it did
+    not finish. Returns the number of requests requeued.
+    """
+    client = get_redis_client()
+
+    client.hdel(WORKERS, worker_id)
+    client.delete(HEARTBEAT_PREFIX + worker_id)
+
+    return _requeue_in_flight(worker_id)
+
+
+def workers():
+    """Returns the info of the live workers along with the UUIDs of the
+    requests each has in flight.
+    """
+    client = get_redis_client()
+
+    registry = client.hgetall(WORKERS)
+    ids = sorted(registry)
+
+    with client.pipeline(transaction=False) as p:
+        for worker_id in ids:
+            p.exists(HEARTBEAT_PREFIX + worker_id)
+            p.hgetall(IN_FLIGHT_PREFIX + worker_id)
+
+        results = p.execute()
+
+    live = []
+
+    for i, worker_id in enumerate(ids):
+        alive, in_flight = results[i * 2], results[i * 2 + 1]
+
+        if not alive:
+            continue
+
+        info = json.loads(registry[worker_id])
+        info['in_flight'] = sorted(in_flight, key=in_flight.get)
+        live.append(info)
+
+    return live
+
+
+def reap():
+    """Removes workers whose heartbeat expired from the registry and
+    requeues the requests they did not finish. Returns the number of
+    requests requeued.
+    """
+    client = get_redis_client()
+
+    ids = sorted(client.hgetall(WORKERS))
+
+    with client.pipeline(transaction=False) as p:
+        for worker_id in ids:
+            p.exists(HEARTBEAT_PREFIX + worker_id)
+
+        alive = p.execute()
+
+    requeued = 0
+
+    for worker_id, alive in zip(ids, alive):
+        # Only one process reaps a worker
+        if alive or not client.hdel(WORKERS, worker_id):
+            continue
+
+        n = _requeue_in_flight(worker_id)
+        requeued += n
+
+        logger.warning('worker {} is dead, requeued {} requests'
+                       .format(worker_id, n))
+
+    return requeued
+
+
+def _requeue_in_flight(worker_id):
+    client = get_redis_client()
+    key = IN_FLIGHT_PREFIX + worker_id
+
+    # Newest first so the oldest is popped first
+    in_flight = client.hgetall(key)
+    uuids = sorted(in_flight, key=in_flight.get, reverse=True)
+
+    n = sum(1 for uuid in uuids if _requeue(uuid))
+    client.delete(key)
+
+    reaped_total.inc(n)
+
+    return n
+
+
+def _requeue(uuid):
+    "Puts a queued or pending request back on the front of its queue."
+    client = get_redis_client()
+    key = REQ_PREFIX + uuid
+
+    try:
+        with client.pipeline() as p:
+            p.watch(key)
+
+            status, tenant = p.hmget(key, 'status', 'tenant')
+
+            # Finished or canceled in the meantime
+            if status not in {QUEUED, PENDING}:
+                return False
+
+            p.multi()
+
+            if status == PENDING:
+                _set_status(p, key, QUEUED)
+
+            p.rpush(_queue_key(tenant), uuid)
+            p.execute()
+    except redis.WatchError:
+        watch_errors_total.inc(operation='requeue')
+        return False
+
+    return True
 
 
 def flush():
     "Flush htq keys from redis"
     client = get_redis_client()
-    prefixes = [REQ_IDS, REQ_PREFIX, REQ_SEND_QUEUE, RESP_PREFIX]
+    prefixes = [REQ_IDS, REQ_PREFIX, RESP_PREFIX, CANCEL_QUEUE,
+                CANCEL_RETRIES, BREAKER_KEY,
+                TENANTS, DEADLINES, DEFERRED, COMPLETED, WORKERS,
+                SLOW_TASKS]
+
+    for worker_id in client.hgetall(WORKERS):
+        prefixes.append(HEARTBEAT_PREFIX + worker_id)
+        prefixes.append(IN_FLIGHT_PREFIX + worker_id)
+
+    prefixes.extend(_tenant_keys(client).values())
+    prefixes.extend(TIMING_PREFIX + phase for phase, _, _ in TIMING_PHASES)
     client.delete(*prefixes)
 
 
-def receive(uuid):
-    "Dequeues and executes a req given it's UUID."
+def receive(uuid, dequeued=None):
+    """Dequeues and executes a req given it's UUID.
+
+    `dequeued` is the timestamp the UUID was popped off the queue, if it
+    differs from the time of the call.
+    """
+    _run_hooks('before_receive', uuid)
+
+    dequeued_total.inc()
+    in_flight.inc()
+
+    try:
+        resp = _receive(uuid, dequeued)
+    finally:
+        in_flight.dec()
+
+    _run_hooks('after_receive', uuid, resp)
+
+    return resp
+
+
+def latency(resp):
+    """Returns the seconds from sending a request upstream to its response
+    being complete. Returns None if the request was not sent, e.g. it was
+    canceled, expired or rejected by an open circuit.
+    """
+    timing = resp and resp.get('timing')
+
+    if not timing or 'sent' not in timing:
+        return
+
+    return (timing['complete'] - timing['sent']) / 1000.0
+
+
+def _receive(uuid, dequeued):
     client = get_redis_client()
 
+    timing = {
+        'dequeued': dequeued or _timestamp(),
+    }
+
     req_key = REQ_PREFIX + uuid
 
     req = _decode_request(client.hgetall(req_key))
@@ -338,7 +1758,43 @@ def receive(uuid):
                        .format(uuid, req['status']))
         return
 
-    client.hset(req_key, 'status', PENDING)
+    # Drop requests that were not sent in time
+    if 'deadline' in req and _timestamp() > req['deadline']:
+        logger.debug('[{}] request expired'.format(uuid))
+        expired_total.inc()
+
+        with client.pipeline() as p:
+            _set_status(p, req_key, EXPIRED)
+            p.zrem(DEADLINES, uuid)
+            p.zadd(COMPLETED, _timestamp(), uuid)
+            p.execute()
+
+        return
+
+    host = urlparse(req['url']).netloc
+    failures = breaker.allow(host)
+
+    # Park the request until the host's circuit lets probes through again,
+    # so workers do not keep popping it while the circuit is open
+    if failures is None and breaker.defer:
+        logger.debug('[{}] circuit open, deferring request'.format(uuid))
+        breaker_rejected_total.inc(host=host)
+
+        due = max(breaker.reopens(host), time.time())
+        client.zadd(DEFERRED, int(due * 1000), uuid)
+        return
+
+    with client.pipeline() as p:
+        _set_status(p, req_key, PENDING)
+        p.execute()
+
+    timing['enqueued'] = req['time']
+    timing['claimed'] = _timestamp()
+
+    body_key = BODY_PREFIX + uuid
+
+    # Left over from an attempt that was requeued
+    client.delete(body_key)
 
     try:
         with client.pipeline() as p:
@@ -347,30 +1803,70 @@ def receive(uuid):
             p.multi()
 
             send_time = _timestamp()
+            t0 = time.perf_counter()
+
+            # Timeouts and connection errors count against the host
+            failed = False
 
             try:
+                if failures is None:
+                    raise CircuitOpen('circuit open for {}'.format(host))
+
+                timing['sent'] = send_time
+
                 logger.debug('[{}] sending request...'.format(uuid))
 
                 rp = requests.request(url=req['url'],
                                       method=req['method'],
                                       data=req.get('data'),
                                       headers=req['headers'],
-                                      timeout=req['timeout'])
+                                      timeout=req['timeout'],
+                                      stream=True)
+
+                # The elapsed time covers sending the request until the
+                # response headers are parsed
+                timing['first_byte'] = send_time + int(
+                    rp.elapsed.total_seconds() * 1000)
+
+                size, truncated = _store_body(client, body_key, rp)
 
                 logger.debug('[{}] response received'.format(uuid))
 
+                upstream_seconds.observe(time.perf_counter() - t0,
+                                         host=host, status=rp.status_code)
+
+                if truncated:
+                    logger.warning('[{}] response body truncated at {} '
+                                   'bytes'.format(uuid, size))
+                    truncated_total.inc()
+
                 resp = {
                     'uuid': uuid,
                     'status': 'success',
                     'elapsed': rp.elapsed.total_seconds() * 1000,
                     'code': rp.status_code,
                     'reason': rp.reason,
-                    'data': rp.text,
                     'headers': dict(rp.headers),
+                    'size': size,
+                    'charset': rp.encoding,
+                    'truncated': truncated,
+                }
+            except CircuitOpen as e:
+                logger.debug('[{}] circuit open'.format(uuid))
+
+                breaker_rejected_total.inc(host=host)
+
+                resp = {
+                    'status': 'error',
+                    'message': str(e),
                 }
             except requests.Timeout as e:
                 logger.debug('[{}] request timeout'.format(uuid))
 
+                upstream_seconds.observe(time.perf_counter() - t0,
+                                         host=host, status=TIMEOUT)
+                failed = True
+
                 resp = {
                     'status': 'timeout',
                     'message': str(e),
@@ -378,23 +1874,82 @@ def receive(uuid):
             except requests.RequestException as e:
                 logger.debug('[{}] request error'.format(uuid))
 
+                upstream_seconds.observe(time.perf_counter() - t0,
+                                         host=host, status=ERROR)
+                failed = isinstance(e, requests.ConnectionError)
+
                 resp = {
                     'status': 'error',
                     'message': str(e),
                 }
 
+            timing['complete'] = _timestamp()
+
+            if failed:
+                if breaker.failure(host):
+                    breaker_opened_total.inc(host=host)
+                    logger.warning('circuit opened for {}'.format(host))
+            elif failures is not None:
+                breaker.success(host, failures)
+
             resp['time'] = send_time
+            resp['timing'] = timing
             resp_key = RESP_PREFIX + uuid
 
+            # Drop the part of the body read before an error
+            if resp['status'] != SUCCESS:
+                p.delete(body_key)
+
             # Update status of request and store response
-            p.hset(req_key, 'status', resp['status'])
+            _set_status(p, req_key, resp['status'])
+
             p.hmset(resp_key, _encode_response(resp))
+            p.zadd(COMPLETED, timing['complete'], uuid)
             p.execute()
+    except Exception as e:
+        if isinstance(e, redis.WatchError):
+            watch_errors_total.inc(operation='receive')
 
-            return resp
-    except Exception:
         # Re-queue on front of queue on watch error or some other
         # unexpected error
-        client.rpush(REQ_SEND_QUEUE, uuid)
+        client.delete(body_key)
+        client.rpush(_queue_key(req['tenant']), uuid)
+        requeued_total.inc()
 
         logger.exception('[{}] receive error, requeuing request'.format(uuid))
+        return
+
+    # Taken once the response is written so the store phase covers it
+    timing['stored'] = _timestamp()
+
+    try:
+        _store_timing(client, req_key, resp_key, req, resp)
+    except Exception:
+        logger.exception('[{}] error storing timing'.format(uuid))
+
+    return resp
+
+
+def _store_timing(client, req_key, resp_key, req, resp):
+    """Adds the stored timestamp to a response that was just written and
+    records its timing, unless the request or response was deleted in the
+    meantime. The version is incremented so clients that cached the
+    response without the timestamp fetch it again.
+    """
+    with client.pipeline() as p:
+        p.watch(req_key, resp_key)
+
+        # Purged or canceled since it was stored
+        if not p.exists(req_key) or not p.exists(resp_key):
+            return
+
+        p.multi()
+        p.hmset(resp_key, _encode_response(resp))
+        p.hincrby(req_key, 'version', 1)
+        _record_timing(p, resp['timing'])
+        _record_slow(p, req, resp, resp['timing'])
+
+        try:
+            p.execute()
+        except redis.WatchError:
+            watch_errors_total.inc(operation='timing')
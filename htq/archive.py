@@ -0,0 +1,218 @@
+"""Append-only archive of completed requests and their responses.
+
+Records are written as JSON lines to gzip compressed segment files in a
+directory. Each segment is a series of gzip members, so a segment can be
+read as a whole with standard tools while a single record can be read by
+decompressing just the member containing it. An SQLite index maps the
+UUID of each record to its segment and the offset of its member.
+Segments are rotated once they reach `segment_size` bytes.
+"""
+
+import os
+import re
+import json
+import zlib
+import gzip
+import sqlite3
+import threading
+
+
+__all__ = ('Archive', 'get_archive', 'set_archive')
+
+
+# Default size in bytes at which a new segment is started
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Records per gzip member. Smaller members make lookups cheaper at the
+# expense of the compression ratio
+MEMBER_SIZE = 100
+
+SEGMENT_NAME = 'segment-{:08d}.jsonl.gz'
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{8})\.jsonl\.gz$')
+
+INDEX_NAME = 'index.db'
+
+INDEX_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS htq_archive ('
+    ' uuid TEXT PRIMARY KEY,'
+    ' segment INTEGER NOT NULL,'
+    ' offset INTEGER NOT NULL)'
+)
+
+
+_archive = None
+
+
+def get_archive():
+    """Returns the archive, or None if no archive is configured.
+
+    The archive directory is read from the HTQ_ARCHIVE environment variable
+    on first use. See `set_archive` for configuring it explicitly.
+    """
+    global _archive
+
+    if _archive is None:
+        path = os.environ.get('HTQ_ARCHIVE')
+
+        if path:
+            _archive = Archive(path)
+
+    return _archive
+
+
+def set_archive(path, **kwargs):
+    "Sets the archive directory, or disables the archive if path is None."
+    global _archive
+
+    _archive = Archive(path, **kwargs) if path else None
+
+    return _archive
+
+
+class Archive(object):
+    """Archive stored in a directory.
+
+    A single process should write to an archive at a time while any number
+    of processes can read from it.
+    """
+    def __init__(self, path, segment_size=SEGMENT_SIZE,
+                 member_size=MEMBER_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.member_size = member_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def _index(self):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.path, INDEX_NAME),
+                                   timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(INDEX_SCHEMA)
+
+            self._local.conn = conn
+
+        return conn
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, SEGMENT_NAME.format(segment))
+
+    def segments(self):
+        "Returns the sorted numbers of the segments."
+        numbers = []
+
+        for name in os.listdir(self.path):
+            match = SEGMENT_PATTERN.match(name)
+
+            if match:
+                numbers.append(int(match.group(1)))
+
+        return sorted(numbers)
+
+    def _current_segment(self):
+        segments = self.segments()
+
+        if not segments:
+            return 1
+
+        segment = segments[-1]
+
+        if os.path.getsize(self._segment_path(segment)) >= self.segment_size:
+            return segment + 1
+
+        return segment
+
+    def write(self, records):
+        """Appends records to the archive. Each record is a dict with at
+        least a `uuid` key. Records that were already archived are replaced
+        in the index.
+        """
+        if not records:
+            return
+
+        with self._lock:
+            entries = []
+
+            for i in range(0, len(records), self.member_size):
+                chunk = records[i:i + self.member_size]
+
+                data = ''.join(json.dumps(r, sort_keys=True) + '\n'
+                               for r in chunk).encode('utf8')
+
+                segment = self._current_segment()
+
+                with open(self._segment_path(segment), 'ab') as f:
+                    offset = f.tell()
+                    f.write(gzip.compress(data))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                entries.extend((r['uuid'], segment, offset) for r in chunk)
+
+            # Records are only indexed once they are durably written
+            index = self._index
+
+            index.execute('BEGIN IMMEDIATE')
+
+            try:
+                index.executemany('INSERT OR REPLACE INTO htq_archive '
+                                  '(uuid, segment, offset) VALUES (?, ?, ?)',
+                                  entries)
+            except Exception:
+                index.execute('ROLLBACK')
+                raise
+
+            index.execute('COMMIT')
+
+    def _read_member(self, segment, offset):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = []
+
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+
+            while not decompressor.eof:
+                data = f.read(64 * 1024)
+
+                if not data:
+                    break
+
+                chunks.append(decompressor.decompress(data))
+
+        return b''.join(chunks).decode('utf8')
+
+    def get(self, uuid):
+        "Returns the archived record of a request, or None."
+        row = self._index.execute('SELECT segment, offset FROM htq_archive '
+                                  'WHERE uuid = ?', (uuid,)).fetchone()
+
+        if not row:
+            return
+
+        for line in self._read_member(*row).splitlines():
+            record = json.loads(line)
+
+            if record['uuid'] == uuid:
+                return record
+
+    def __contains__(self, uuid):
+        return self._index.execute('SELECT 1 FROM htq_archive '
+                                   'WHERE uuid = ?', (uuid,)).fetchone() \
+            is not None
+
+    def __len__(self):
+        return self._index.execute('SELECT COUNT(*) FROM htq_archive') \
+            .fetchone()[0]
+
+    def __iter__(self):
+        "Iterates over all records in the order they were archived."
+        for segment in self.segments():
+            with gzip.open(self._segment_path(segment), 'rt',
+                           encoding='utf8') as f:
+                for line in f:
+                    yield json.loads(line)
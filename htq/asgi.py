@@ -0,0 +1,573 @@
+"""ASGI version of the REST service.
+
+Serves the same routes as `htq.service` from an event loop so clients
+waiting on a response do not tie up a thread each. Storage is read with an
+asyncio client and waiting clients are resolved by a single task that
+polls the status of all awaited requests in one round trip. Writes, which
+share their transaction logic with the API, run in a thread pool.
+
+Run it with any ASGI server, e.g. `uvicorn htq.asgi:app` or
+`htq server --async`.
+"""
+
+import re
+import json
+import asyncio
+import functools
+from urllib.parse import parse_qs
+from werkzeug.http import parse_etags, quote_etag
+import htq
+from . import metrics, encoding, profiler
+from .api import (REQ_PREFIX, QUEUED, PENDING, _decode_request,
+                  _decode_response, _set_data, _archived_field,
+                  _archived_records, _unknown, _read_statuses,
+                  _read_response, _read_responses, _status_results,
+                  _response_results)
+from .db import get_async_client
+from .service import build_link_header
+
+
+__all__ = ('app', 'Waiter')
+
+
+# Seconds between polls of the status of awaited requests
+POLL_INTERVAL = 0.1
+
+ROUTE = re.compile(r'^/(?P<uuid>[^/]+)/(?:(?P<sub>status|response)/)?$')
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        self.status = status
+
+
+class Waiter(object):
+    """Waits for requests to complete.
+
+    Futures of awaited requests are resolved with the status of the request
+    once it is no longer queued or pending. The status of every awaited
+    request is fetched in one pipelined round trip per interval, so the
+    cost of polling does not depend on the number of waiting clients.
+    """
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self._futures = {}
+        self._task = None
+
+    def wait(self, uuid):
+        "Returns a future of the status of the request once complete."
+        future = asyncio.get_running_loop().create_future()
+        self._futures.setdefault(uuid, []).append(future)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._poll())
+
+        return future
+
+    async def _poll(self):
+        client = get_async_client()
+
+        while self._futures:
+            # Drop clients that went away
+            for uuid in list(self._futures):
+                futures = [f for f in self._futures[uuid] if not f.done()]
+
+                if futures:
+                    self._futures[uuid] = futures
+                else:
+                    del self._futures[uuid]
+
+            uuids = list(self._futures)
+
+            if uuids:
+                try:
+                    async with client.pipeline(transaction=False) as p:
+                        for uuid in uuids:
+                            p.hget(REQ_PREFIX + uuid, 'status')
+
+                        statuses = await p.execute()
+                except Exception:
+                    htq.logger.exception('error polling request statuses')
+                    statuses = [QUEUED] * len(uuids)
+
+                for uuid, status in zip(uuids, statuses):
+                    if status in {QUEUED, PENDING}:
+                        continue
+
+                    for future in self._futures.pop(uuid):
+                        if not future.done():
+                            future.set_result(status)
+
+            await asyncio.sleep(self.interval)
+
+
+waiter = Waiter()
+
+
+async def _sync(func, *args, **kwargs):
+    "Runs a blocking function in the thread pool."
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(
+        None, functools.partial(func, *args, **kwargs))
+
+
+async def _request(uuid):
+    req = _decode_request(await get_async_client().hgetall(REQ_PREFIX + uuid))
+
+    if req is None:
+        req = await _sync(_archived_field, uuid, 'request')
+
+    return req
+
+
+async def _state(uuid):
+    "Returns the status and version of a request."
+    status, version = await get_async_client().hmget(
+        REQ_PREFIX + uuid, 'status', 'version')
+
+    if status is None:
+        req = await _request(uuid)
+
+        if req:
+            return req['status'], req.get('version', 0)
+
+        return None, None
+
+    return status, int(version or 0)
+
+
+async def _response(uuid):
+    async with get_async_client().pipeline(transaction=False) as p:
+        _read_response(p, uuid)
+        resp, chunks = await p.execute()
+
+    resp = _set_data(_decode_response(resp), chunks)
+
+    if resp is None:
+        resp = await _sync(_archived_field, uuid, 'response')
+
+    return resp
+
+
+async def _statuses(uuids, completed):
+    async with get_async_client().pipeline(transaction=False) as p:
+        _read_statuses(p, uuids)
+        results = await p.execute()
+
+    records = await _sync(_archived_records, _unknown(uuids, results))
+
+    return _status_results(uuids, results, records, completed)
+
+
+async def _responses(uuids, completed):
+    async with get_async_client().pipeline(transaction=False) as p:
+        _read_responses(p, uuids)
+        results = await p.execute()
+
+    records = await _sync(_archived_records,
+                          _unknown(uuids, results[::3]))
+
+    return _response_results(uuids, results, records, completed)
+
+
+class Request(object):
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope['method'].upper()
+        self.path = scope['path']
+        self.args = {k: v[0] for k, v in
+                     parse_qs(scope.get('query_string', b'').decode()).items()}
+        self.headers = {k.decode('latin1').lower(): v.decode('latin1')
+                        for k, v in scope.get('headers', ())}
+
+    def url_for(self, uuid=None, sub=None):
+        "Returns the external URL of the queue or a request."
+        host = self.headers.get('host')
+
+        if not host:
+            server = self.scope.get('server') or ('localhost', 80)
+            host = '{}:{}'.format(*server)
+
+        url = '{}://{}{}/'.format(self.scope.get('scheme', 'http'), host,
+                                  self.scope.get('root_path', ''))
+
+        if uuid:
+            url += uuid + '/'
+
+        if sub:
+            url += sub + '/'
+
+        return url
+
+    def arg(self, name, default=None, type=str):
+        """Returns a query argument converted with `type`, or the default
+        if it is missing or invalid.
+        """
+        try:
+            return type(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+    async def body(self):
+        chunks = []
+
+        while True:
+            message = await self.receive()
+
+            if message['type'] == 'http.disconnect':
+                raise HTTPError(400)
+
+            chunks.append(message.get('body', b''))
+
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def payload(self):
+        "Returns the decoded body."
+        mimetype = self.headers.get('content-type', '')
+        mimetype = mimetype.split(';')[0].strip()
+
+        try:
+            return encoding.loads(await self.body(), mimetype)
+        except ImportError:
+            raise HTTPError(415)
+        except ValueError:
+            raise HTTPError(400)
+
+    async def uuids(self):
+        """Returns the UUIDs and the completed flag of the body of a batch
+        lookup.
+        """
+        payload = await self.payload()
+
+        if not isinstance(payload, dict):
+            raise HTTPError(400)
+
+        uuids = payload.get('uuids')
+
+        if (not isinstance(uuids, list) or
+                not all(isinstance(uuid, str) for uuid in uuids)):
+            raise HTTPError(422)
+
+        return uuids, bool(payload.get('completed'))
+
+    def has_version(self, version):
+        "Returns true if the client already has the version of a request."
+        return parse_etags(self.headers.get('if-none-match')) \
+            .contains_weak(str(version))
+
+    async def disconnected(self):
+        "Returns once the client disconnects."
+        while True:
+            message = await self.receive()
+
+            if message['type'] == 'http.disconnect':
+                return
+
+
+class Response(object):
+    def __init__(self, body=b'', status=200, content_type=None,
+                 headers=None):
+        if not isinstance(body, bytes):
+            body = body.encode('utf8')
+
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+
+        if content_type:
+            self.headers['Content-Type'] = content_type
+
+    async def __call__(self, send):
+        headers = [(k.lower().encode('latin1'), v.encode('latin1'))
+                   for k, v in self.headers.items()]
+        headers.append((b'content-length', str(len(self.body)).encode()))
+
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': headers,
+        })
+
+        await send({
+            'type': 'http.response.body',
+            'body': self.body,
+        })
+
+
+def json_response(data, status=200):
+    return Response(json.dumps(data), status, encoding.JSON)
+
+
+def not_modified(version):
+    return Response(status=304, headers={
+        'ETag': quote_etag(str(version), weak=True),
+        'Vary': 'Accept',
+    })
+
+
+def payload_response(request, data, links=None, version=None):
+    "Returns a response with the data encoded in the accepted type."
+    mimetype = encoding.best_match(request.headers.get('accept'))
+    headers = {'Vary': 'Accept'}
+
+    if links:
+        headers['Link'] = build_link_header(links)
+
+    if version is not None:
+        headers['ETag'] = quote_etag(str(version), weak=True)
+
+    return Response(encoding.dumps(data, mimetype), 200, mimetype, headers)
+
+
+async def queue(request):
+    reqs = await _sync(htq.queued, tenant=request.args.get('tenant'))
+
+    for req in reqs:
+        req['links'] = {
+            'self': request.url_for(req['uuid']),
+            'status': request.url_for(req['uuid'], 'status'),
+            'response': request.url_for(req['uuid'], 'response'),
+        }
+
+    return payload_response(request, reqs, links={
+        request.url_for(): {
+            'rel': 'self',
+        },
+    })
+
+
+async def send(request):
+    data = await request.payload()
+
+    if not isinstance(data, dict):
+        raise HTTPError(400)
+
+    if 'url' not in data:
+        raise HTTPError(422)
+
+    try:
+        req = await _sync(htq.send,
+                          url=data['url'],
+                          method=data.get('method'),
+                          data=data.get('data'),
+                          headers=data.get('headers'),
+                          timeout=data.get('timeout'),
+                          tenant=data.get('tenant'),
+                          ttl=data.get('ttl'),
+                          deadline=data.get('deadline'))
+    except ValueError:
+        raise HTTPError(422)
+
+    # Redirect to request endpoint
+    return Response(status=303, headers={
+        'Location': request.url_for(req['uuid']),
+    })
+
+
+async def timings(request):
+    return payload_response(request, await _sync(htq.timings))
+
+
+async def workers(request):
+    return payload_response(request, await _sync(htq.workers))
+
+
+async def export_metrics(request):
+    return Response(metrics.REGISTRY.render(), 200, metrics.CONTENT_TYPE)
+
+
+async def slow_tasks(request):
+    return payload_response(request, await _sync(
+        htq.slow_tasks, request.arg('limit', 100, int)))
+
+
+async def profile(request):
+    if not profiler.enabled():
+        raise HTTPError(404)
+
+    stacks = await _sync(profiler.profile, request.arg('seconds', 10, float))
+
+    return Response(stacks, 200, profiler.CONTENT_TYPE)
+
+
+async def statuses(request):
+    uuids, completed = await request.uuids()
+
+    return payload_response(request, await _statuses(uuids, completed))
+
+
+async def responses(request):
+    uuids, completed = await request.uuids()
+
+    return payload_response(request, await _responses(uuids, completed))
+
+
+async def get_request(request, uuid):
+    status, version = await _state(uuid)
+
+    if status is None:
+        raise HTTPError(404)
+
+    if request.has_version(version):
+        return not_modified(version)
+
+    req = await _request(uuid)
+
+    if req is None:
+        raise HTTPError(404)
+
+    return payload_response(request, req, version=req['version'], links={
+        request.url_for(uuid): {
+            'rel': 'self',
+        },
+        request.url_for(uuid, 'status'): {
+            'rel': 'status',
+        },
+        request.url_for(uuid, 'response'): {
+            'rel': 'response',
+        },
+    })
+
+
+async def status(request, uuid):
+    status, version = await _state(uuid)
+
+    if not status:
+        raise HTTPError(404)
+
+    if request.has_version(version):
+        return not_modified(version)
+
+    return payload_response(request, {'status': status}, version=version)
+
+
+async def cancel(request, uuid):
+    if not await _sync(htq.cancel, uuid):
+        raise HTTPError(404)
+
+    return Response(status=204)
+
+
+async def response(request, uuid):
+    status, version = await _state(uuid)
+
+    if not status:
+        raise HTTPError(404)
+
+    # Wait until complete or the client goes away
+    if status in {QUEUED, PENDING}:
+        done = waiter.wait(uuid)
+        gone = asyncio.ensure_future(request.disconnected())
+
+        await asyncio.wait([done, gone],
+                           return_when=asyncio.FIRST_COMPLETED)
+
+        if not done.done():
+            done.cancel()
+            return
+
+        gone.cancel()
+
+        status, version = await _state(uuid)
+
+    if version is not None and request.has_version(version):
+        return not_modified(version)
+
+    rp = await _response(uuid) or {}
+
+    return payload_response(request, rp, version=version, links={
+        request.url_for(uuid, 'response'): {
+            'rel': 'self',
+        },
+        request.url_for(uuid): {
+            'rel': 'request',
+        },
+    })
+
+
+async def purge(request, uuid):
+    if not await _sync(htq.purge, uuid):
+        raise HTTPError(404)
+
+    return Response(status=204)
+
+
+ROUTES = {
+    '/': {'GET': queue, 'POST': send},
+    '/timings/': {'GET': timings},
+    '/workers': {'GET': workers},
+    '/metrics': {'GET': export_metrics},
+    '/slow': {'GET': slow_tasks},
+    '/profile': {'GET': profile},
+    '/status': {'POST': statuses},
+    '/responses': {'POST': responses},
+}
+
+REQUEST_ROUTES = {
+    None: {'GET': get_request, 'DELETE': cancel},
+    'status': {'GET': status},
+    'response': {'GET': response, 'DELETE': purge},
+}
+
+
+def _route(request):
+    "Returns the handler and arguments for a request."
+    args = ()
+    methods = ROUTES.get(request.path)
+
+    if methods is None:
+        match = ROUTE.match(request.path)
+
+        if not match:
+            raise HTTPError(404)
+
+        methods = REQUEST_ROUTES[match.group('sub')]
+        args = (match.group('uuid'),)
+
+    # HEAD is answered like Flask does, without a body
+    method = 'GET' if request.method == 'HEAD' else request.method
+
+    if method not in methods:
+        raise HTTPError(405)
+
+    return methods[method], args
+
+
+async def app(scope, receive, send):
+    "ASGI application of the REST service."
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    request = Request(scope, receive)
+
+    try:
+        handler, args = _route(request)
+        resp = await handler(request, *args)
+    except HTTPError as e:
+        resp = json_response({'status': e.status}, e.status)
+    except Exception:
+        htq.logger.exception('error handling {} {}'
+                             .format(request.method, request.path))
+        resp = json_response({'status': 500}, 500)
+
+    # Client disconnected
+    if resp is None:
+        return
+
+    if request.method == 'HEAD':
+        resp.body = b''
+
+    await resp(send)
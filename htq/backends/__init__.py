@@ -0,0 +1,47 @@
+"""Storage backends.
+
+htq talks to storage through the subset of Redis commands it needs, so any
+client implementing them can stand in for Redis. Besides Redis itself, an
+in-memory backend (embedded use and tests) and a SQLite backend (single node
+deployments) are provided.
+"""
+
+try:
+    from urllib.parse import urlparse
+except ImportError:  # pragma: no cover
+    from urlparse import urlparse
+
+import redis
+
+
+__all__ = ('get_backend',)
+
+
+def get_backend(url):
+    """Returns a client for the storage backend URL.
+
+    Supported URLs:
+
+        redis://localhost:6379/0
+        sqlite:///path/to/htq.db
+        memory://
+    """
+    scheme = urlparse(url).scheme
+
+    if scheme in ('redis', 'rediss', 'unix'):
+        return redis.StrictRedis.from_url(url, decode_responses=True)
+
+    if scheme == 'sqlite':
+        from .sqlite import SQLiteClient
+
+        # sqlite:///relative/path or sqlite:////absolute/path, following
+        # the SQLAlchemy convention
+        path = url[len('sqlite:///'):] or ':memory:'
+
+        return SQLiteClient(path)
+
+    if scheme == 'memory':
+        from .memory import MemoryClient
+        return MemoryClient()
+
+    raise ValueError('unknown storage backend "{}"'.format(url))
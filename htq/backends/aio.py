@@ -0,0 +1,66 @@
+import asyncio
+import functools
+
+
+class AsyncClient(object):
+    """Asyncio interface to a synchronous storage client.
+
+    Commands are run in a thread pool so they do not block the event loop.
+    The interface matches the asyncio client of redis-py: commands are
+    coroutines and pipeline commands are buffered until the pipeline is
+    executed.
+    """
+    def __init__(self, client, executor=None):
+        self._client = client
+        self._executor = executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    def pipeline(self, transaction=True):
+        return AsyncPipeline(self, self._client.pipeline(transaction))
+
+    def __getattr__(self, name):
+        func = getattr(self._client, name)
+
+        if name.startswith('_') or not callable(func):
+            return func
+
+        async def command(*args, **kwargs):
+            return await self._run(func, *args, **kwargs)
+
+        return command
+
+
+class AsyncPipeline(object):
+    def __init__(self, client, pipeline):
+        self._client = client
+        self._pipeline = pipeline
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self._pipeline.reset()
+
+    def __len__(self):
+        return len(self._pipeline)
+
+    async def execute(self):
+        return await self._client._run(self._pipeline.execute)
+
+    def __getattr__(self, name):
+        func = getattr(self._pipeline, name)
+
+        if name.startswith('_') or not callable(func):
+            return func
+
+        @functools.wraps(func)
+        def command(*args, **kwargs):
+            func(*args, **kwargs)
+            return self
+
+        return command
@@ -0,0 +1,194 @@
+import time
+import redis
+
+
+WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+
+def encode(value):
+    "Encodes a value the way the Redis client does before sending it."
+    if isinstance(value, bytes):
+        return value.decode('utf8')
+
+    return str(value)
+
+
+def score(value):
+    "Parses a score bound, returning the score and whether it is exclusive."
+    if isinstance(value, str) and value.startswith('('):
+        return float(value[1:]), True
+
+    return float(value), False
+
+
+def zadd_pairs(args, kwargs):
+    """Returns the (member, score) pairs passed to zadd.
+
+    This follows the StrictRedis signature of the pinned redis client,
+    i.e. `zadd(name, score1, member1, score2, member2, member3=score3)`.
+    """
+    if len(args) % 2:
+        raise redis.RedisError('ZADD requires an equal number of '
+                               'values and scores')
+
+    pairs = [(encode(m), float(s)) for s, m in zip(args[::2], args[1::2])]
+    pairs.extend((encode(m), float(s)) for m, s in kwargs.items())
+
+    return pairs
+
+
+def expiry(ex=None, px=None):
+    "Returns the time a key set with an expire in seconds or ms expires."
+    if ex is not None:
+        return time.time() + ex
+
+    if px is not None:
+        return time.time() + px / 1000.0
+
+
+def list_range(length, start, stop):
+    "Converts an inclusive Redis range into a Python slice."
+    if start < 0:
+        start = max(length + start, 0)
+
+    if stop < 0:
+        stop = length + stop
+
+    return slice(start, stop + 1)
+
+
+class Pipeline(object):
+    """Pipeline compatible with the subset of the redis-py pipeline htq uses.
+
+    Commands are buffered and applied atomically on `execute()`. Following
+    redis-py, commands issued after `watch()` but before `multi()` are
+    executed immediately, and `execute()` raises `redis.WatchError` if a
+    watched key was written to since it was watched.
+    """
+    def __init__(self, client, transaction=True):
+        self.client = client
+        self.transaction = transaction
+        self.reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def reset(self):
+        self.command_stack = []
+        self.watching = {}
+        self.explicit_transaction = False
+
+    def watch(self, *keys):
+        for key in keys:
+            self.watching[key] = self.client._version(key)
+
+    def unwatch(self):
+        self.watching = {}
+
+    def multi(self):
+        self.explicit_transaction = True
+
+    def execute(self, raise_on_error=True):
+        stack = self.command_stack
+
+        try:
+            if not stack and not self.watching:
+                return []
+
+            readonly = all(name in self.client.read_commands
+                           for name, _, _ in stack)
+
+            with self.client._atomic(readonly):
+                for key, version in self.watching.items():
+                    if self.client._version(key) != version:
+                        raise redis.WatchError('Watched variable changed.')
+
+                return [getattr(self.client, name)(*args, **kwargs)
+                        for name, args, kwargs in stack]
+        finally:
+            self.reset()
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.client.commands:
+            raise AttributeError(name)
+
+        # Immediate mode
+        if self.watching and not self.explicit_transaction:
+            return getattr(self.client, name)
+
+        def buffer(*args, **kwargs):
+            self.command_stack.append((name, args, kwargs))
+            return self
+
+        return buffer
+
+
+class Client(object):
+    """Base class of the in-process storage backends.
+
+    Subclasses implement the Redis commands listed in `commands` along with
+    `_atomic(readonly=False)`, a re-entrant context manager that makes a
+    group of commands atomic, and `_version(key)` which returns a value that
+    changes every time the key is written.
+    """
+    commands = (
+        'delete',
+        'exists',
+        'get',
+        'hdel',
+        'hget',
+        'hgetall',
+        'hincrby',
+        'hmget',
+        'hmset',
+        'hset',
+        'hsetnx',
+        'llen',
+        'lpush',
+        'lrange',
+        'lrem',
+        'ltrim',
+        'rpop',
+        'rpush',
+        'brpop',
+        'set',
+        'zadd',
+        'zcard',
+        'zrangebyscore',
+        'zrem',
+    )
+
+    # Commands that do not write, which pipelines of only these commands
+    # may run without taking a write lock
+    read_commands = frozenset((
+        'exists',
+        'get',
+        'hget',
+        'hgetall',
+        'hmget',
+        'llen',
+        'lrange',
+        'zcard',
+        'zrangebyscore',
+    ))
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self, transaction=transaction)
+
+    def hmset(self, name, mapping):
+        return self.hset(name, mapping=mapping) is not None
+
+    def brpop(self, keys, timeout=0):
+        raise NotImplementedError
+
+    def flushdb(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
@@ -0,0 +1,377 @@
+import time
+import itertools
+import threading
+from collections import deque
+import redis
+from .base import (Client, WRONGTYPE, encode, expiry, list_range, score,
+                   zadd_pairs)
+
+
+class MemoryClient(Client):
+    """Thread-safe in-memory backend.
+
+    State lives in the process so the server and workers must share it,
+    e.g. when htq is embedded in an application or under test.
+    """
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._versions = {}
+        self._counter = itertools.count(1)
+        self._lock = threading.RLock()
+        self._pushed = threading.Condition(self._lock)
+
+    def _atomic(self, readonly=False):
+        return self._lock
+
+    def _version(self, key):
+        return self._versions.get(key)
+
+    def _touch(self, key):
+        self._versions[key] = next(self._counter)
+
+    def _expire(self, key):
+        "Removes the key if it has expired."
+        expires = self._expires.get(key)
+
+        if expires is not None and expires <= time.time():
+            del self._expires[key]
+            self._data.pop(key, None)
+            self._touch(key)
+
+    def _get(self, key, kind):
+        self._expire(key)
+        value = self._data.get(key)
+
+        if value is not None and not isinstance(value, kind):
+            raise redis.ResponseError(WRONGTYPE)
+
+        return value
+
+    def _cleanup(self, key):
+        # Redis removes empty containers
+        if not self._data[key]:
+            del self._data[key]
+
+    def flushdb(self):
+        with self._lock:
+            for key in self._data:
+                self._touch(key)
+
+            self._data.clear()
+            self._expires.clear()
+
+        return True
+
+    def delete(self, *names):
+        n = 0
+
+        with self._lock:
+            for name in names:
+                self._expire(name)
+                self._expires.pop(name, None)
+
+                if self._data.pop(name, None) is not None:
+                    self._touch(name)
+                    n += 1
+
+        return n
+
+    def exists(self, *names):
+        with self._lock:
+            for name in names:
+                self._expire(name)
+
+            return sum(1 for name in names if name in self._data)
+
+    def get(self, name):
+        with self._lock:
+            return self._get(name, str)
+
+    def set(self, name, value, ex=None, px=None):
+        value = encode(value)
+        expires = expiry(ex, px)
+
+        with self._lock:
+            self._data[name] = value
+            self._expires.pop(name, None)
+
+            if expires is not None:
+                self._expires[name] = expires
+
+            self._touch(name)
+
+        return True
+
+    def hget(self, name, key):
+        with self._lock:
+            h = self._get(name, dict)
+
+            if h is not None:
+                return h.get(key)
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, str):
+            keys = [keys]
+
+        keys = list(keys) + list(args)
+
+        with self._lock:
+            h = self._get(name, dict) or {}
+            return [h.get(key) for key in keys]
+
+    def hdel(self, name, *keys):
+        with self._lock:
+            h = self._get(name, dict)
+
+            if not h:
+                return 0
+
+            n = sum(1 for key in keys if h.pop(key, None) is not None)
+
+            if n:
+                self._cleanup(name)
+                self._touch(name)
+
+            return n
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._get(name, dict) or {})
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        items = {}
+
+        if key is not None:
+            items[key] = value
+
+        if mapping:
+            items.update(mapping)
+
+        if not items:
+            raise redis.DataError("'hset' with no key value pairs")
+
+        items = {encode(k): encode(v) for k, v in items.items()}
+
+        with self._lock:
+            h = self._get(name, dict)
+
+            if h is None:
+                h = self._data[name] = {}
+
+            n = sum(1 for k in items if k not in h)
+            h.update(items)
+            self._touch(name)
+
+        return n
+
+    def hsetnx(self, name, key, value):
+        with self._lock:
+            if self.hget(name, key) is not None:
+                return False
+
+            return bool(self.hset(name, key, value))
+
+    def hincrby(self, name, key, amount=1):
+        key = encode(key)
+
+        with self._lock:
+            h = self._get(name, dict)
+
+            if h is None:
+                h = self._data[name] = {}
+
+            try:
+                value = int(h.get(key, 0)) + int(amount)
+            except ValueError:
+                raise redis.ResponseError('hash value is not an integer')
+
+            h[key] = str(value)
+            self._touch(name)
+
+            return value
+
+    def llen(self, name):
+        with self._lock:
+            return len(self._get(name, deque) or ())
+
+    def lrange(self, name, start, end):
+        with self._lock:
+            items = self._get(name, deque)
+
+            if not items:
+                return []
+
+            s = list_range(len(items), start, end)
+
+            return list(itertools.islice(items, s.start, max(s.start, s.stop)))
+
+    def lrem(self, name, count, value):
+        value = encode(value)
+
+        with self._lock:
+            items = self._get(name, deque)
+
+            if not items:
+                return 0
+
+            # A negative count removes from the tail
+            ordered = list(items) if count >= 0 else list(reversed(items))
+            limit = abs(count) or len(ordered)
+            kept = []
+            n = 0
+
+            for item in ordered:
+                if n < limit and item == value:
+                    n += 1
+                else:
+                    kept.append(item)
+
+            if count < 0:
+                kept.reverse()
+
+            if n:
+                items.clear()
+                items.extend(kept)
+                self._cleanup(name)
+                self._touch(name)
+
+            return n
+
+    def ltrim(self, name, start, end):
+        with self._lock:
+            items = self._get(name, deque)
+
+            if not items:
+                return True
+
+            s = list_range(len(items), start, end)
+            kept = list(itertools.islice(items, s.start, max(s.start, s.stop)))
+
+            if len(kept) != len(items):
+                items.clear()
+                items.extend(kept)
+                self._cleanup(name)
+                self._touch(name)
+
+            return True
+
+    def _push(self, name, values, left):
+        values = [encode(v) for v in values]
+
+        with self._lock:
+            items = self._get(name, deque)
+
+            if items is None:
+                items = self._data[name] = deque()
+
+            if left:
+                items.extendleft(values)
+            else:
+                items.extend(values)
+
+            self._touch(name)
+            self._pushed.notify_all()
+
+            return len(items)
+
+    def lpush(self, name, *values):
+        return self._push(name, values, left=True)
+
+    def rpush(self, name, *values):
+        return self._push(name, values, left=False)
+
+    def rpop(self, name):
+        with self._lock:
+            items = self._get(name, deque)
+
+            if not items:
+                return
+
+            value = items.pop()
+            self._cleanup(name)
+            self._touch(name)
+
+            return value
+
+    def brpop(self, keys, timeout=0):
+        if isinstance(keys, str):
+            keys = [keys]
+
+        deadline = time.time() + timeout if timeout else None
+
+        with self._lock:
+            while True:
+                for key in keys:
+                    value = self.rpop(key)
+
+                    if value is not None:
+                        return key, value
+
+                if deadline is None:
+                    self._pushed.wait()
+                else:
+                    remaining = deadline - time.time()
+
+                    if remaining <= 0:
+                        return
+
+                    self._pushed.wait(remaining)
+
+    def zadd(self, name, *args, **kwargs):
+        pairs = zadd_pairs(args, kwargs)
+
+        with self._lock:
+            z = self._get(name, ZSet)
+
+            if z is None:
+                z = self._data[name] = ZSet()
+
+            n = sum(1 for member, _ in pairs if member not in z)
+            z.update(pairs)
+            self._touch(name)
+
+            return n
+
+    def zrem(self, name, *values):
+        with self._lock:
+            z = self._get(name, ZSet)
+
+            if not z:
+                return 0
+
+            n = sum(1 for v in values if z.pop(encode(v), None) is not None)
+
+            if n:
+                self._cleanup(name)
+                self._touch(name)
+
+            return n
+
+    def zcard(self, name):
+        with self._lock:
+            return len(self._get(name, ZSet) or ())
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        lo, lo_open = score(min)
+        hi, hi_open = score(max)
+
+        with self._lock:
+            z = self._get(name, ZSet) or {}
+
+            items = sorted(((s, m) for m, s in z.items()
+                            if (lo < s if lo_open else lo <= s) and
+                            (s < hi if hi_open else s <= hi)))
+
+        if start is not None and num is not None:
+            items = items[start:start + num if num >= 0 else None]
+
+        if withscores:
+            return [(m, score_cast_func(s)) for s, m in items]
+
+        return [m for s, m in items]
+
+
+class ZSet(dict):
+    "Sorted set of member to score."
@@ -0,0 +1,590 @@
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+import redis
+from .base import (Client, WRONGTYPE, encode, expiry, list_range, score,
+                   zadd_pairs)
+
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS htq_keys ('
+    ' key TEXT PRIMARY KEY,'
+    ' type TEXT NOT NULL,'
+    ' version INTEGER NOT NULL,'
+    # Number of items of a list so the length is not counted on each push
+    ' length INTEGER NOT NULL DEFAULT 0,'
+    # Time the key expires at, if it was set with an expire
+    ' expires REAL)',
+
+    'CREATE TABLE IF NOT EXISTS htq_strings ('
+    ' key TEXT PRIMARY KEY,'
+    ' value TEXT NOT NULL) WITHOUT ROWID',
+
+    'CREATE TABLE IF NOT EXISTS htq_hashes ('
+    ' key TEXT NOT NULL,'
+    ' field TEXT NOT NULL,'
+    ' value TEXT NOT NULL,'
+    ' PRIMARY KEY (key, field)) WITHOUT ROWID',
+
+    'CREATE TABLE IF NOT EXISTS htq_lists ('
+    ' key TEXT NOT NULL,'
+    ' pos INTEGER NOT NULL,'
+    ' value TEXT NOT NULL,'
+    ' PRIMARY KEY (key, pos)) WITHOUT ROWID',
+
+    'CREATE TABLE IF NOT EXISTS htq_zsets ('
+    ' key TEXT NOT NULL,'
+    ' member TEXT NOT NULL,'
+    ' score REAL NOT NULL,'
+    ' PRIMARY KEY (key, member)) WITHOUT ROWID',
+
+    'CREATE INDEX IF NOT EXISTS htq_zsets_score ON htq_zsets (key, score)',
+
+    # Single row counter used to version keys
+    'CREATE TABLE IF NOT EXISTS htq_seq (n INTEGER NOT NULL)',
+    'INSERT INTO htq_seq SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM htq_seq)',
+)
+
+TABLES = ('htq_strings', 'htq_hashes', 'htq_lists', 'htq_zsets')
+
+# Interval between polls of a blocking pop
+POLL_INTERVAL = 0.05
+
+
+class SQLiteClient(Client):
+    """SQLite backend for single node deployments.
+
+    The database is opened in WAL mode so the server and any number of
+    worker processes on the same host can share the file. Each thread uses
+    its own connection.
+    """
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+        # The in-memory database is private to a connection, so it is
+        # shared across threads
+        if path == ':memory:':
+            self._shared = self._connect(check_same_thread=False)
+            self._shared_lock = threading.RLock()
+        else:
+            self._shared = None
+
+        with self._atomic() as c:
+            for sql in SCHEMA:
+                c.execute(sql)
+
+    def _connect(self, **kwargs):
+        conn = sqlite3.connect(self.path,
+                               timeout=self.timeout,
+                               isolation_level=None,
+                               **kwargs)
+
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+
+        return conn
+
+    @property
+    def _conn(self):
+        if self._shared is not None:
+            return self._shared
+
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._local.depth = 0
+
+        return conn
+
+    @contextmanager
+    def _atomic(self, readonly=False):
+        if self._shared is not None:
+            self._shared_lock.acquire()
+
+        conn = self._conn
+        depth = getattr(self._local, 'depth', 0)
+
+        try:
+            if depth == 0:
+                # Reads use a deferred transaction so they do not take the
+                # write lock and run alongside writers in WAL mode
+                conn.execute('BEGIN' if readonly else 'BEGIN IMMEDIATE')
+                self._local.readonly = readonly
+            elif readonly < self._local.readonly:
+                raise RuntimeError('write in a read-only transaction')
+
+            self._local.depth = depth + 1
+
+            try:
+                yield conn
+            except BaseException:
+                if depth == 0:
+                    conn.execute('ROLLBACK')
+                raise
+
+            if depth == 0:
+                conn.execute('COMMIT')
+        finally:
+            self._local.depth = depth
+
+            if self._shared is not None:
+                self._shared_lock.release()
+
+    def _version(self, key):
+        row = self._conn.execute('SELECT version FROM htq_keys WHERE key = ?',
+                                 (key,)).fetchone()
+
+        if row:
+            return row[0]
+
+    def _type(self, c, key):
+        row = c.execute('SELECT type, expires FROM htq_keys WHERE key = ?',
+                        (key,)).fetchone()
+
+        if not row:
+            return
+
+        # Expired keys are removed when they are next written to
+        if row[1] is not None and row[1] <= time.time():
+            if not self._local.readonly:
+                self._remove(c, key)
+
+            return
+
+        return row[0]
+
+    def _check(self, c, key, kind):
+        "Returns true if the key exists and is of the passed type."
+        t = self._type(c, key)
+
+        if t is not None and t != kind:
+            raise redis.ResponseError(WRONGTYPE)
+
+        return t is not None
+
+    def _touch(self, c, key, kind):
+        c.execute('UPDATE htq_seq SET n = n + 1')
+        c.execute('INSERT INTO htq_keys (key, type, version) '
+                  'VALUES (?, ?, (SELECT n FROM htq_seq)) '
+                  'ON CONFLICT (key) DO UPDATE SET version = excluded.version',
+                  (key, kind))
+
+    def _resize(self, c, key, delta):
+        "Adjusts the length of a list and returns it."
+        c.execute('UPDATE htq_keys SET length = length + ? WHERE key = ?',
+                  (delta, key))
+
+        length = c.execute('SELECT length FROM htq_keys WHERE key = ?',
+                           (key,)).fetchone()[0]
+
+        # Redis removes empty containers
+        if not length:
+            self._remove(c, key)
+
+        return length
+
+    def _remove(self, c, key):
+        for table in TABLES:
+            c.execute('DELETE FROM {} WHERE key = ?'.format(table), (key,))
+
+        return c.execute('DELETE FROM htq_keys WHERE key = ?',
+                         (key,)).rowcount
+
+    def _cleanup(self, c, key, table):
+        # Redis removes empty containers
+        row = c.execute('SELECT 1 FROM {} WHERE key = ? LIMIT 1'
+                        .format(table), (key,)).fetchone()
+
+        if not row:
+            self._remove(c, key)
+
+    def flushdb(self):
+        with self._atomic() as c:
+            for table in TABLES:
+                c.execute('DELETE FROM {}'.format(table))
+
+            c.execute('DELETE FROM htq_keys')
+
+        return True
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def delete(self, *names):
+        with self._atomic() as c:
+            return sum(self._remove(c, name) for name in names
+                       if self._type(c, name))
+
+    def exists(self, *names):
+        with self._atomic(readonly=True) as c:
+            return sum(1 for name in names if self._type(c, name))
+
+    def get(self, name):
+        with self._atomic(readonly=True) as c:
+            if not self._check(c, name, 'string'):
+                return
+
+            return c.execute('SELECT value FROM htq_strings WHERE key = ?',
+                             (name,)).fetchone()[0]
+
+    def set(self, name, value, ex=None, px=None):
+        value = encode(value)
+        expires = expiry(ex, px)
+
+        with self._atomic() as c:
+            self._remove(c, name)
+
+            c.execute('INSERT INTO htq_strings (key, value) VALUES (?, ?)',
+                      (name, value))
+
+            self._touch(c, name, 'string')
+
+            c.execute('UPDATE htq_keys SET expires = ? WHERE key = ?',
+                      (expires, name))
+
+        return True
+
+    def hget(self, name, key):
+        with self._atomic(readonly=True) as c:
+            self._check(c, name, 'hash')
+
+            row = c.execute('SELECT value FROM htq_hashes '
+                            'WHERE key = ? AND field = ?',
+                            (name, key)).fetchone()
+            if row:
+                return row[0]
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, str):
+            keys = [keys]
+
+        keys = list(keys) + list(args)
+
+        with self._atomic(readonly=True) as c:
+            self._check(c, name, 'hash')
+
+            values = dict(c.execute(
+                'SELECT field, value FROM htq_hashes WHERE key = ? '
+                'AND field IN ({})'.format(', '.join('?' * len(keys))),
+                [name] + keys))
+
+            return [values.get(key) for key in keys]
+
+    def hdel(self, name, *keys):
+        with self._atomic() as c:
+            if not self._check(c, name, 'hash'):
+                return 0
+
+            n = sum(c.execute('DELETE FROM htq_hashes '
+                              'WHERE key = ? AND field = ?',
+                              (name, key)).rowcount for key in keys)
+
+            if n:
+                self._touch(c, name, 'hash')
+                self._cleanup(c, name, 'htq_hashes')
+
+            return n
+
+    def hgetall(self, name):
+        with self._atomic(readonly=True) as c:
+            self._check(c, name, 'hash')
+
+            return dict(c.execute('SELECT field, value FROM htq_hashes '
+                                  'WHERE key = ?', (name,)))
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        items = {}
+
+        if key is not None:
+            items[key] = value
+
+        if mapping:
+            items.update(mapping)
+
+        if not items:
+            raise redis.DataError("'hset' with no key value pairs")
+
+        items = [(name, encode(k), encode(v)) for k, v in items.items()]
+
+        with self._atomic() as c:
+            self._check(c, name, 'hash')
+
+            n = 0
+
+            for item in items:
+                n += c.execute('INSERT OR IGNORE INTO htq_hashes '
+                               '(key, field, value) VALUES (?, ?, ?)',
+                               item).rowcount
+
+            c.executemany('UPDATE htq_hashes SET value = ? '
+                          'WHERE key = ? AND field = ?',
+                          [(v, k, f) for k, f, v in items])
+
+            self._touch(c, name, 'hash')
+
+        return n
+
+    def hsetnx(self, name, key, value):
+        with self._atomic():
+            if self.hget(name, key) is not None:
+                return False
+
+            return bool(self.hset(name, key, value))
+
+    def hincrby(self, name, key, amount=1):
+        key = encode(key)
+
+        with self._atomic() as c:
+            self._check(c, name, 'hash')
+
+            row = c.execute('SELECT value FROM htq_hashes '
+                            'WHERE key = ? AND field = ?',
+                            (name, key)).fetchone()
+
+            try:
+                value = int(row[0] if row else 0) + int(amount)
+            except ValueError:
+                raise redis.ResponseError('hash value is not an integer')
+
+            c.execute('INSERT OR REPLACE INTO htq_hashes (key, field, value) '
+                      'VALUES (?, ?, ?)', (name, key, str(value)))
+
+            self._touch(c, name, 'hash')
+
+            return value
+
+    def llen(self, name):
+        with self._atomic(readonly=True) as c:
+            self._check(c, name, 'list')
+
+            row = c.execute('SELECT length FROM htq_keys WHERE key = ?',
+                            (name,)).fetchone()
+
+            return row[0] if row else 0
+
+    def lrange(self, name, start, end):
+        with self._atomic(readonly=True) as c:
+            if not self._check(c, name, 'list'):
+                return []
+
+            if start < 0 or end < 0:
+                s = list_range(self.llen(name), start, end)
+                start, end = s.start, s.stop - 1
+
+            if end < start:
+                return []
+
+            return [row[0] for row in c.execute(
+                'SELECT value FROM htq_lists WHERE key = ? '
+                'ORDER BY pos LIMIT ? OFFSET ?',
+                (name, end - start + 1, start))]
+
+    def lrem(self, name, count, value):
+        value = encode(value)
+
+        with self._atomic() as c:
+            if not self._check(c, name, 'list'):
+                return 0
+
+            # A negative count removes from the tail
+            rows = c.execute('SELECT pos FROM htq_lists '
+                             'WHERE key = ? AND value = ? '
+                             'ORDER BY pos {} LIMIT ?'
+                             .format('DESC' if count < 0 else 'ASC'),
+                             (name, value, abs(count) or -1)).fetchall()
+
+            c.executemany('DELETE FROM htq_lists WHERE key = ? AND pos = ?',
+                          [(name, row[0]) for row in rows])
+
+            if rows:
+                self._touch(c, name, 'list')
+                self._resize(c, name, -len(rows))
+
+            return len(rows)
+
+    def ltrim(self, name, start, end):
+        with self._atomic() as c:
+            if not self._check(c, name, 'list'):
+                return True
+
+            s = list_range(self.llen(name), start, end)
+
+            if s.stop <= s.start:
+                self._remove(c, name)
+                return True
+
+            first, last = [c.execute('SELECT pos FROM htq_lists '
+                                     'WHERE key = ? ORDER BY pos '
+                                     'LIMIT 1 OFFSET ?',
+                                     (name, i)).fetchone()
+                           for i in (s.start, s.stop - 1)]
+
+            if first is None:
+                self._remove(c, name)
+                return True
+
+            # The range may extend past the end of the list
+            if last is None:
+                where = 'pos < ?'
+                args = (name, first[0])
+            else:
+                where = '(pos < ? OR pos > ?)'
+                args = (name, first[0], last[0])
+
+            n = c.execute('DELETE FROM htq_lists WHERE key = ? AND ' + where,
+                          args).rowcount
+
+            if n:
+                self._touch(c, name, 'list')
+                self._resize(c, name, -n)
+
+            return True
+
+    def _push(self, name, values, left):
+        values = [encode(v) for v in values]
+
+        with self._atomic() as c:
+            self._check(c, name, 'list')
+
+            if left:
+                pos = c.execute('SELECT MIN(pos) FROM htq_lists '
+                                'WHERE key = ?', (name,)).fetchone()[0]
+                pos = 0 if pos is None else pos
+                rows = [(name, pos - i - 1, v) for i, v in enumerate(values)]
+            else:
+                pos = c.execute('SELECT MAX(pos) FROM htq_lists '
+                                'WHERE key = ?', (name,)).fetchone()[0]
+                pos = 0 if pos is None else pos
+                rows = [(name, pos + i + 1, v) for i, v in enumerate(values)]
+
+            c.executemany('INSERT INTO htq_lists (key, pos, value) '
+                          'VALUES (?, ?, ?)', rows)
+
+            self._touch(c, name, 'list')
+
+            return self._resize(c, name, len(rows))
+
+    def lpush(self, name, *values):
+        return self._push(name, values, left=True)
+
+    def rpush(self, name, *values):
+        return self._push(name, values, left=False)
+
+    def rpop(self, name):
+        with self._atomic() as c:
+            if not self._check(c, name, 'list'):
+                return
+
+            pos, value = c.execute('SELECT pos, value FROM htq_lists '
+                                   'WHERE key = ? ORDER BY pos DESC LIMIT 1',
+                                   (name,)).fetchone()
+
+            c.execute('DELETE FROM htq_lists WHERE key = ? AND pos = ?',
+                      (name, pos))
+
+            self._touch(c, name, 'list')
+            self._resize(c, name, -1)
+
+            return value
+
+    def brpop(self, keys, timeout=0):
+        if isinstance(keys, str):
+            keys = [keys]
+
+        deadline = time.time() + timeout if timeout else None
+
+        marks = ', '.join('?' * len(keys))
+
+        # Other processes may push, so poll. The write lock is only taken
+        # once one of the lists has items.
+        while True:
+            with self._atomic(readonly=True) as c:
+                ready = c.execute('SELECT 1 FROM htq_lists '
+                                  'WHERE key IN ({}) LIMIT 1'.format(marks),
+                                  keys).fetchone()
+
+            if ready:
+                with self._atomic():
+                    for key in keys:
+                        value = self.rpop(key)
+
+                        if value is not None:
+                            return key, value
+
+            if deadline is not None and time.time() >= deadline:
+                return
+
+            time.sleep(POLL_INTERVAL)
+
+    def zadd(self, name, *args, **kwargs):
+        pairs = zadd_pairs(args, kwargs)
+
+        with self._atomic() as c:
+            self._check(c, name, 'zset')
+
+            n = 0
+
+            for member, s in pairs:
+                n += c.execute('INSERT OR IGNORE INTO htq_zsets '
+                               '(key, member, score) VALUES (?, ?, ?)',
+                               (name, member, s)).rowcount
+
+                c.execute('UPDATE htq_zsets SET score = ? '
+                          'WHERE key = ? AND member = ?', (s, name, member))
+
+            self._touch(c, name, 'zset')
+
+            return n
+
+    def zrem(self, name, *values):
+        with self._atomic() as c:
+            if not self._check(c, name, 'zset'):
+                return 0
+
+            n = sum(c.execute('DELETE FROM htq_zsets '
+                              'WHERE key = ? AND member = ?',
+                              (name, encode(v))).rowcount for v in values)
+
+            if n:
+                self._touch(c, name, 'zset')
+                self._cleanup(c, name, 'htq_zsets')
+
+            return n
+
+    def zcard(self, name):
+        with self._atomic(readonly=True) as c:
+            self._check(c, name, 'zset')
+
+            return c.execute('SELECT COUNT(*) FROM htq_zsets WHERE key = ?',
+                             (name,)).fetchone()[0]
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        lo, lo_open = score(min)
+        hi, hi_open = score(max)
+
+        if start is None or num is None:
+            start, num = 0, -1
+
+        with self._atomic(readonly=True) as c:
+            self._check(c, name, 'zset')
+
+            rows = c.execute(
+                'SELECT member, score FROM htq_zsets WHERE key = ? '
+                'AND score {} ? AND score {} ? '
+                'ORDER BY score, member LIMIT ? OFFSET ?'
+                .format('>' if lo_open else '>=', '<' if hi_open else '<='),
+                (name, lo, hi, num, start)).fetchall()
+
+        if withscores:
+            return [(m, score_cast_func(s)) for m, s in rows]
+
+        return [m for m, s in rows]
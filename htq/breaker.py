@@ -0,0 +1,105 @@
+import time
+import requests
+from .db import get_redis_client
+
+
+# Hash of the breaker state of each host, shared by all workers
+BREAKER_KEY = 'htq:breakers'
+
+
+class CircuitOpen(requests.RequestException):
+    "Raised in place of sending a request to a host with an open circuit."
+
+
+class CircuitBreaker(object):
+    """Per-host circuit breaker.
+
+    After `threshold` consecutive timeouts or connection errors to a host
+    the circuit opens and requests to the host are rejected for `cooldown`
+    seconds. Then up to `probes` requests are let through per cooldown
+    period until one succeeds, which closes the circuit, or fails, which
+    opens it again. A threshold of zero disables the breaker.
+
+    Rejected requests fail with an error unless `defer` is true, in which
+    case they are put back on the queue once the cooldown is over.
+    """
+    def __init__(self, threshold=5, cooldown=30, probes=1, defer=False):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probes = probes
+        self.defer = defer
+
+    def _fields(self, host):
+        return host + ':failures', host + ':opened', host + ':probes'
+
+    def allow(self, host):
+        """Returns the number of failures recorded for the host, or None if
+        the request should be rejected.
+        """
+        if not self.threshold:
+            return 0
+
+        client = get_redis_client()
+
+        f_failures, f_opened, f_probes = self._fields(host)
+        failures, opened = client.hmget(BREAKER_KEY, f_failures, f_opened)
+        failures = int(failures or 0)
+
+        if failures < self.threshold:
+            return failures
+
+        now = time.time()
+
+        if now < float(opened or 0) + self.cooldown:
+            return
+
+        # Half-open, let the probes of this period through
+        n = client.hincrby(BREAKER_KEY, f_probes, 1)
+
+        if n > self.probes:
+            return
+
+        # Start the next period once the last probe is out
+        if n == self.probes:
+            client.hmset(BREAKER_KEY, {f_opened: now, f_probes: 0})
+
+        return failures
+
+    def reopens(self, host):
+        """Returns the time the circuit of the host lets the probes of the
+        next period through.
+        """
+        opened = get_redis_client().hget(BREAKER_KEY, host + ':opened')
+
+        return float(opened or 0) + self.cooldown
+
+    def success(self, host, failures):
+        "Closes the circuit if failures were recorded for the host."
+        if self.threshold and failures:
+            get_redis_client().hdel(BREAKER_KEY, *self._fields(host))
+
+    def failure(self, host):
+        "Records a failure and returns true if it opened the circuit."
+        if not self.threshold:
+            return False
+
+        client = get_redis_client()
+
+        f_failures, f_opened, f_probes = self._fields(host)
+        failures = client.hincrby(BREAKER_KEY, f_failures, 1)
+
+        if failures < self.threshold:
+            return False
+
+        client.hmset(BREAKER_KEY, {f_opened: time.time(), f_probes: 0})
+
+        return failures == self.threshold
+
+    def reset(self, host=None):
+        "Closes the circuit of the host or of all hosts."
+        client = get_redis_client()
+
+        if host:
+            client.hdel(BREAKER_KEY, *self._fields(host))
+        else:
+            client.delete(BREAKER_KEY)
@@ -1,14 +1,89 @@
+import os
 import redis
+from .backends import get_backend
 
 
 _redis_client = None
 
 
 def get_redis_client(*args, **kwargs):
+    """Returns the storage client, creating it on first use.
+
+    By default this is a Redis client. If the HTQ_BACKEND environment
+    variable is set to a backend URL, that backend is used instead.
+    See `set_backend` for configuring it explicitly.
+    """
     global _redis_client
 
     if not _redis_client:
-        kwargs['decode_responses'] = True
-        _redis_client = redis.StrictRedis(*args, **kwargs)
+        url = os.environ.get('HTQ_BACKEND')
+
+        if url and not args and not kwargs:
+            _redis_client = get_backend(url)
+        else:
+            kwargs['decode_responses'] = True
+            _redis_client = redis.StrictRedis(*args, **kwargs)
+
+    return _redis_client
+
+
+def set_backend(url):
+    "Sets the storage backend by URL, e.g. memory:// or sqlite:///htq.db"
+    global _redis_client, _async_client
+
+    _redis_client = get_backend(url)
+    _async_client = None
 
     return _redis_client
+
+
+_async_client = None
+
+# Connection settings carried over to the asyncio Redis client
+ASYNC_CONNECTION_KWARGS = ('host', 'port', 'db', 'username', 'password',
+                           'socket_timeout', 'socket_connect_timeout')
+
+
+def get_async_client():
+    """Returns an asyncio client for the storage client, creating it on
+    first use.
+
+    Redis is accessed with the asyncio client of redis-py if it is
+    available. Other backends, and Redis with older versions of redis-py,
+    run the commands of the synchronous client in a thread pool.
+    """
+    global _async_client
+
+    if not _async_client:
+        client = get_redis_client()
+
+        # Unwrap the instrumented client
+        raw = getattr(client, '_client', client)
+
+        if isinstance(raw, redis.StrictRedis):
+            _async_client = _async_redis(raw)
+
+        if not _async_client:
+            from .backends.aio import AsyncClient
+            _async_client = AsyncClient(client)
+
+    return _async_client
+
+
+def _async_redis(client):
+    try:
+        from redis import asyncio as aioredis
+    except ImportError:
+        return
+
+    pool = client.connection_pool
+    kwargs = {k: v for k, v in pool.connection_kwargs.items()
+              if k in ASYNC_CONNECTION_KWARGS}
+
+    if 'path' in pool.connection_kwargs:
+        kwargs['unix_socket_path'] = pool.connection_kwargs['path']
+
+    if issubclass(pool.connection_class, redis.SSLConnection):
+        kwargs['ssl'] = True
+
+    return aioredis.StrictRedis(decode_responses=True, **kwargs)
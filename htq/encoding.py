@@ -0,0 +1,80 @@
+"""Optional msgpack encoding of stored requests and API payloads.
+
+msgpack is only required when the compact storage encoding is turned on
+or a client asks for `application/msgpack`.
+"""
+
+import json
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+__all__ = ('JSON', 'MSGPACK', 'require', 'pack_text', 'unpack_text',
+           'best_match', 'dumps', 'loads')
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+
+def require():
+    "Raises ImportError if msgpack is not installed."
+    if msgpack is None:
+        raise ImportError('msgpack is required for the compact encoding, '
+                          'install it with `pip install htq[msgpack]`')
+
+
+def pack_text(obj):
+    """Packs an object and returns it as text.
+
+    Storage clients decode values as UTF-8 text, so the packed bytes are
+    stored as latin-1 text which maps each byte to one code point.
+    """
+    require()
+    return msgpack.packb(obj, use_bin_type=True).decode('latin1')
+
+
+def unpack_text(text):
+    "Unpacks an object packed by `pack_text`."
+    require()
+    return msgpack.unpackb(text.encode('latin1'), raw=False)
+
+
+def best_match(accept):
+    """Returns the payload type for the value of an Accept header. JSON is
+    the default and msgpack is only chosen if it is installed.
+    """
+    types = [JSON]
+
+    if msgpack is not None:
+        types.append(MSGPACK)
+
+    return parse_accept_header(accept, MIMEAccept).best_match(
+        types, default=JSON) or JSON
+
+
+def dumps(data, mimetype=JSON):
+    "Encodes an API payload as bytes."
+    if mimetype == MSGPACK:
+        require()
+        return msgpack.packb(data, use_bin_type=True)
+
+    return json.dumps(data).encode('utf8')
+
+
+def loads(body, mimetype=JSON):
+    "Decodes an API payload. Raises ValueError if it is invalid."
+    if mimetype == MSGPACK:
+        require()
+
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception as e:
+            raise ValueError(str(e))
+
+    return json.loads(body.decode('utf8'))
@@ -0,0 +1,112 @@
+import threading
+
+
+class AIMDLimiter(object):
+    """Concurrency limit adjusted by additive-increase/multiplicative-decrease.
+
+    The limit grows by one each time a full limit's worth of requests
+    completes without a timeout while there is a backlog, and is multiplied
+    by `backoff` when a request in the window timed out, more than
+    `error_rate` of its requests failed or the average latency exceeds
+    `tolerance` times the baseline. The baseline is the lowest average
+    latency seen and slowly drifts up so a lasting change in upstream
+    latency is eventually accepted. The limit is only changed at the end
+    of each limit's worth of completions so a burst of timeouts counts
+    once.
+
+    `backlog` is an optional callable returning the number of requests
+    waiting to be sent.
+    """
+    def __init__(self, floor=1, ceiling=100, initial=None, backoff=0.5,
+                 tolerance=2.0, smoothing=0.1, drift=0.001, error_rate=0.5,
+                 backlog=None):
+        if not 1 <= floor <= ceiling:
+            raise ValueError('floor must be between 1 and the ceiling')
+
+        self.floor = floor
+        self.ceiling = ceiling
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.drift = drift
+        self.error_rate = error_rate
+        self.backlog = backlog
+
+        self._limit = float(initial or floor)
+        self._in_flight = 0
+        self._completed = 0
+        self._errors = 0
+        self._timed_out = False
+        self._average = None
+        self._baseline = None
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self):
+        "Blocks until the number of requests in flight is below the limit."
+        with self._cond:
+            while self._in_flight >= int(self._limit):
+                self._cond.wait()
+
+            self._in_flight += 1
+
+    def release(self, latency=None, timeout=False, error=False):
+        """Releases a slot and adjusts the limit given the latency of the
+        request in seconds and whether it timed out or failed.
+        """
+        with self._cond:
+            self._in_flight -= 1
+            self._completed += 1
+
+            if latency is not None:
+                self._observe(latency)
+
+            if timeout:
+                self._timed_out = True
+
+            if error:
+                self._errors += 1
+
+            # Decide at the end of the window
+            if self._completed >= int(self._limit):
+                if (self._timed_out or self._congested() or
+                        self._errors > self._completed * self.error_rate):
+                    self._set(self._limit * self.backoff)
+                elif self._has_backlog():
+                    self._set(self._limit + 1)
+                else:
+                    self._reset()
+
+            self._cond.notify_all()
+
+    def _observe(self, latency):
+        if self._average is None:
+            self._average = self._baseline = latency
+            return
+
+        self._average += self.smoothing * (latency - self._average)
+        self._baseline = min(self._baseline * (1 + self.drift), self._average)
+
+    def _congested(self):
+        return (self._average is not None and
+                self._average > self._baseline * self.tolerance)
+
+    def _has_backlog(self):
+        return self.backlog is None or self.backlog() > 0
+
+    def _set(self, limit):
+        self._limit = min(max(limit, self.floor), self.ceiling)
+        self._reset()
+
+    def _reset(self):
+        "Starts a new window."
+        self._completed = 0
+        self._errors = 0
+        self._timed_out = False
@@ -0,0 +1,76 @@
+"""Bulk loading of requests from JSON lines.
+
+Each line is a JSON object with the same attributes as the body of
+`POST /`. Requests are validated and queued in pipelined batches so only a
+batch is held in memory at a time.
+"""
+
+import json
+import time
+from .api import REQUEST_ATTRIBUTES, send_many, logger, _check_request
+
+
+__all__ = ('validate', 'load')
+
+
+def validate(obj):
+    """Returns the send() arguments of a request object or raises
+    ValueError. The attributes are checked by the same rules as send().
+    """
+    if not isinstance(obj, dict):
+        raise ValueError('request must be an object')
+
+    unknown = set(obj) - set(REQUEST_ATTRIBUTES)
+
+    if unknown:
+        raise ValueError('unknown attributes: {}'
+                         .format(', '.join(sorted(unknown))))
+
+    _check_request(obj)
+
+    return obj
+
+
+def load(lines, batch_size=1000, progress=None, interval=1):
+    """Validates and queues the requests of an iterable of JSON lines.
+
+    Invalid lines are logged and skipped. If passed, `progress` is called
+    with the number of loaded and invalid requests and the elapsed seconds
+    at most every `interval` seconds and once at the end. Returns the number
+    of loaded and invalid requests.
+    """
+    loaded = invalid = 0
+    batch = []
+
+    t0 = last = time.time()
+
+    for n, line in enumerate(lines, 1):
+        line = line.strip()
+
+        if not line:
+            continue
+
+        try:
+            batch.append(validate(json.loads(line)))
+        except ValueError as e:
+            invalid += 1
+            logger.warning('line {}: {}'.format(n, e))
+            continue
+
+        if len(batch) >= batch_size:
+            send_many(batch)
+            loaded += len(batch)
+            batch = []
+
+            if progress and time.time() - last >= interval:
+                last = time.time()
+                progress(loaded, invalid, last - t0)
+
+    if batch:
+        send_many(batch)
+        loaded += len(batch)
+
+    if progress:
+        progress(loaded, invalid, time.time() - t0)
+
+    return loaded, invalid
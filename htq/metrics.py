@@ -0,0 +1,330 @@
+"""In-process metrics exported in the Prometheus text format.
+
+Metrics are process local: the REST service exports the metrics of the
+server process at `/metrics` and `htq worker --metrics-port <port>` serves
+the metrics of a worker.
+"""
+
+import time
+import bisect
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from . import profiler
+
+
+__all__ = (
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'Registry',
+    'REGISTRY',
+    'instrument',
+    'start_http_server',
+)
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+
+    if extra:
+        pairs.append(extra)
+
+    if not pairs:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', r'\\').replace('"', r'\"')
+        .replace('\n', r'\n')) for k, v in pairs) + '}'
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} expects labels {}'
+                             .format(self.name, self.labels))
+
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        "Returns a list of (suffix, label values, extra label, value)."
+        with self._lock:
+            return [('', key, None, value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+
+        for suffix, key, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, _format_labels(self.labels, key, extra),
+                _format_value(value)))
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Gauge that is either set directly or, if `func` is passed, computed
+    by calling it each time the metrics are collected.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None):
+        Metric.__init__(self, name, help, labels)
+        self.func = func
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.func is None:
+            return Metric.samples(self)
+
+        return [('', (), None, self.func())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(key)
+
+            if counts is None:
+                # Bucket counts followed by the +Inf bucket and the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+
+        for key, counts in values:
+            total = 0
+
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                total += n
+                samples.append(('_bucket', key, ('le', _format_value(bound)),
+                                total))
+
+            samples.append(('_sum', key, None, counts[-1]))
+            samples.append(('_count', key, None, total))
+
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=(), func=None):
+    return REGISTRY.register(Gauge(name, help, labels, func=func))
+
+
+def histogram(name, help, labels=(), buckets=BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+storage_seconds = histogram('htq_storage_seconds',
+                            'Latency of storage commands.',
+                            labels=('command',))
+
+
+# Commands that block waiting for data are not timed
+BLOCKING_COMMANDS = {'blpop', 'brpop', 'brpoplpush'}
+
+
+class InstrumentedPipeline(object):
+    "Pipeline proxy that times execute() and watch()."
+    def __init__(self, pipeline):
+        self._pipeline = pipeline
+
+    def __enter__(self):
+        self._pipeline.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._pipeline.__exit__(*exc)
+
+    def __len__(self):
+        return len(self._pipeline)
+
+    def _timed(self, name, func, *args, **kwargs):
+        t0 = time.perf_counter()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            storage_seconds.observe(time.perf_counter() - t0, command=name)
+
+    def execute(self, *args, **kwargs):
+        return self._timed('pipeline', self._pipeline.execute,
+                           *args, **kwargs)
+
+    def watch(self, *keys):
+        return self._timed('watch', self._pipeline.watch, *keys)
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline, name)
+
+
+class InstrumentedClient(object):
+    "Storage client proxy that records the latency of each command."
+    def __init__(self, client):
+        self._client = client
+
+    def pipeline(self, *args, **kwargs):
+        return InstrumentedPipeline(self._client.pipeline(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+
+        if (name.startswith('_') or name in BLOCKING_COMMANDS or
+                not callable(attr)):
+            return attr
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                storage_seconds.observe(time.perf_counter() - t0,
+                                        command=name)
+
+        return timed
+
+
+def instrument():
+    "Replaces the storage client with one that records command latency."
+    from . import db
+
+    client = db.get_redis_client()
+
+    if not isinstance(client, InstrumentedClient):
+        db._redis_client = InstrumentedClient(client)
+
+    return db._redis_client
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/')
+
+        if path == '/metrics':
+            body = self.server.registry.render().encode('utf8')
+            content_type = CONTENT_TYPE
+
+        # Profiles of the process when profiling is turned on
+        elif path == '/profile' and profiler.enabled():
+            try:
+                seconds = float(parse_qs(url.query)['seconds'][0])
+            except (KeyError, ValueError):
+                seconds = 10
+
+            body = profiler.profile(seconds).encode('utf8')
+            content_type = profiler.CONTENT_TYPE
+
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, host='', registry=REGISTRY):
+    "Serves the metrics at /metrics from a daemon thread."
+    server = MetricsServer((host, port), MetricsHandler)
+    server.registry = registry
+
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+
+    return server
@@ -0,0 +1,160 @@
+"""Sampling profiler that outputs collapsed stacks for flame graphs.
+
+A sampler thread periodically records the stack of every other thread of
+the process. Each line of the output is a stack, from the outermost frame
+to the innermost separated by semicolons, followed by the number of times
+it was seen. This is the input format of flamegraph.pl and speedscope.
+
+Profiling is off unless turned on with `enable()`, which `--profile` does
+for the server and workers.
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+
+
+__all__ = (
+    'Sampler',
+    'profile',
+    'enable',
+    'enabled',
+    'install_signal_handler',
+)
+
+
+logger = logging.getLogger('htq')
+
+CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+# Default seconds between samples
+INTERVAL = 0.005
+
+# Maximum seconds a profile requested on demand may run
+MAX_SECONDS = 60
+
+_enabled = False
+
+
+def enable(enabled=True):
+    "Sets whether profiles can be requested from the REST service."
+    global _enabled
+    _enabled = enabled
+
+
+def enabled():
+    return _enabled
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    path = '/'.join(code.co_filename.split(os.sep)[-2:])
+
+    return '{} ({}:{})'.format(code.co_name, path, code.co_firstlineno)
+
+
+class Sampler(object):
+    "Samples the stacks of the threads of the process from a thread."
+    def __init__(self, interval=INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='htq-profiler')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def _run(self):
+        ident = threading.get_ident()
+
+        while not self._stop.wait(self.interval):
+            self.sample(ignore=ident)
+
+    def sample(self, ignore=None):
+        "Records the current stack of each thread except `ignore`."
+        for ident, frame in sys._current_frames().items():
+            if ident == ignore:
+                continue
+
+            stack = []
+
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+
+            self.stacks[';'.join(reversed(stack))] += 1
+
+        self.samples += 1
+
+    def collapsed(self):
+        "Returns the stacks in the collapsed format."
+        return ''.join('{} {}\n'.format(stack, n)
+                       for stack, n in sorted(self.stacks.items()))
+
+
+def profile(seconds, interval=INTERVAL):
+    """Samples the process for `seconds`, at most MAX_SECONDS, and returns
+    the collapsed stacks.
+    """
+    sampler = Sampler(interval)
+    sampler.start()
+
+    try:
+        time.sleep(max(0, min(seconds, MAX_SECONDS)))
+    finally:
+        sampler.stop()
+
+    return sampler.collapsed()
+
+
+def install_signal_handler(directory, signum=signal.SIGUSR1,
+                           interval=INTERVAL):
+    """Toggles a sampler each time the process receives the signal.
+
+    The first signal starts sampling and the next writes the collapsed
+    stacks to a file in `directory` named after the process id and time.
+    """
+    sampler = Sampler(interval)
+
+    def handler(signum, frame):
+        if not sampler.running:
+            sampler.stacks.clear()
+            sampler.samples = 0
+            sampler.start()
+            logger.info('Started profiling')
+            return
+
+        sampler.stop()
+
+        path = os.path.join(directory, 'htq-{}-{}.collapsed'.format(
+            os.getpid(), time.strftime('%Y%m%d%H%M%S')))
+
+        with open(path, 'w') as f:
+            f.write(sampler.collapsed())
+
+        logger.info('Wrote profile of {} samples to {}'
+                    .format(sampler.samples, path))
+
+    signal.signal(signum, handler)
+
+    return sampler
@@ -1,7 +1,7 @@
 import time
-import json
 from flask import Flask, abort, make_response, url_for, request as http_request
 import htq
+from htq import metrics, encoding, profiler
 
 
 def build_link_header(links):
@@ -36,6 +36,62 @@ def build_link_header(links):
     return ', '.join(_links)
 
 
+def make_payload_response(data, status=200):
+    "Returns a response with the data encoded in the accepted type."
+    mimetype = encoding.best_match(http_request.headers.get('Accept'))
+
+    resp = make_response(encoding.dumps(data, mimetype), status)
+    resp.headers['Content-Type'] = mimetype
+    resp.vary.add('Accept')
+
+    return resp
+
+
+def not_modified(version):
+    """Returns a 304 response if the client already has the version of a
+    request, otherwise None.
+    """
+    etag = str(version)
+
+    if version is not None and http_request.if_none_match.contains_weak(etag):
+        resp = make_response('', 304)
+        resp.set_etag(etag, weak=True)
+        resp.vary.add('Accept')
+
+        return resp
+
+
+def load_payload():
+    "Returns the decoded request body."
+    if http_request.mimetype == encoding.MSGPACK:
+        try:
+            return encoding.loads(http_request.get_data(), encoding.MSGPACK)
+        except ImportError:
+            abort(415)
+        except ValueError:
+            abort(400)
+
+    return http_request.json
+
+
+def load_uuids():
+    """Returns the UUIDs and the completed flag of the body of a batch
+    lookup.
+    """
+    payload = load_payload()
+
+    if not isinstance(payload, dict):
+        abort(400)
+
+    uuids = payload.get('uuids')
+
+    if (not isinstance(uuids, list) or
+            not all(isinstance(uuid, str) for uuid in uuids)):
+        abort(422)
+
+    return uuids, bool(payload.get('completed'))
+
+
 app = Flask('htq')
 
 
@@ -43,7 +99,7 @@ app = Flask('htq')
 def queue():
     reqs = []
 
-    for req in htq.queued():
+    for req in htq.queued(tenant=http_request.args.get('tenant')):
         req['links'] = {
             'self': url_for('request', uuid=req['uuid'], _external=True),
             'status': url_for('status', uuid=req['uuid'], _external=True),
@@ -51,8 +107,7 @@ def queue():
         }
         reqs.append(req)
 
-    resp = make_response(json.dumps(reqs), 200)
-    resp.headers['Content-Type'] = 'application/json'
+    resp = make_payload_response(reqs)
     resp.headers['Link'] = build_link_header({
         url_for('queue', _external=True): {
             'rel': 'self',
@@ -64,7 +119,7 @@ def queue():
 
 @app.route('/', methods=['post'])
 def send():
-    json = http_request.json
+    json = load_payload()
 
     if 'url' not in json:
         abort(422)
@@ -74,12 +129,21 @@ def send():
     data = json.get('data')
     headers = json.get('headers')
     timeout = json.get('timeout')
-
-    req = htq.send(url=url,
-                   method=method,
-                   data=data,
-                   headers=headers,
-                   timeout=timeout)
+    tenant = json.get('tenant')
+    ttl = json.get('ttl')
+    deadline = json.get('deadline')
+
+    try:
+        req = htq.send(url=url,
+                       method=method,
+                       data=data,
+                       headers=headers,
+                       timeout=timeout,
+                       tenant=tenant,
+                       ttl=ttl,
+                       deadline=deadline)
+    except ValueError:
+        abort(422)
 
     # Redirect to request endpoint
     resp = make_response('', 303)
@@ -88,15 +152,84 @@ def send():
     return resp
 
 
+@app.route('/timings/', methods=['get'])
+def timings():
+    "Returns the histograms of the timing phases of received responses."
+    return make_payload_response(htq.timings())
+
+
+@app.route('/workers', methods=['get'])
+def workers():
+    "Returns the live workers and the requests they have in flight."
+    return make_payload_response(htq.workers())
+
+
+@app.route('/metrics', methods=['get'])
+def export_metrics():
+    "Returns the metrics of the server in the Prometheus text format."
+    resp = make_response(metrics.REGISTRY.render(), 200)
+    resp.headers['Content-Type'] = metrics.CONTENT_TYPE
+
+    return resp
+
+
+@app.route('/slow', methods=['get'])
+def slow_tasks():
+    "Returns the most recent requests that were slow to handle."
+    limit = http_request.args.get('limit', 100, type=int)
+
+    return make_payload_response(htq.slow_tasks(limit))
+
+
+@app.route('/profile', methods=['get'])
+def profile():
+    "Samples the server process and returns the collapsed stacks."
+    if not profiler.enabled():
+        abort(404)
+
+    seconds = http_request.args.get('seconds', 10, type=float)
+
+    resp = make_response(profiler.profile(seconds), 200)
+    resp.headers['Content-Type'] = profiler.CONTENT_TYPE
+
+    return resp
+
+
+@app.route('/status', methods=['post'])
+def statuses():
+    "Returns the statuses of a batch of requests."
+    uuids, completed = load_uuids()
+
+    return make_payload_response(htq.statuses(uuids, completed=completed))
+
+
+@app.route('/responses', methods=['post'])
+def responses():
+    "Returns the responses of a batch of requests."
+    uuids, completed = load_uuids()
+
+    return make_payload_response(htq.responses(uuids, completed=completed))
+
+
 @app.route('/<uuid>/', methods=['get'])
 def request(uuid):
+    version = htq.version(uuid)
+
+    if version is None:
+        abort(404)
+
+    resp = not_modified(version)
+
+    if resp:
+        return resp
+
     req = htq.request(uuid)
 
     if req is None:
         abort(404)
 
-    resp = make_response(json.dumps(req), 200)
-    resp.headers['Content-Type'] = 'application/json'
+    resp = make_payload_response(req)
+    resp.set_etag(str(req['version']), weak=True)
     resp.headers['Link'] = build_link_header({
         url_for('request', uuid=uuid, _external=True): {
             'rel': 'self',
@@ -115,13 +248,23 @@ def request(uuid):
 @app.route('/<uuid>/status/', methods=['get'])
 def status(uuid):
     "Returns the status of the request."
+    version = htq.version(uuid)
+
+    if version is None:
+        abort(404)
+
+    resp = not_modified(version)
+
+    if resp:
+        return resp
+
     status = htq.status(uuid)
 
     if not status:
         abort(404)
 
-    resp = make_response(json.dumps({'status': status}), 200)
-    resp.headers['Content-Type'] = 'application/json'
+    resp = make_payload_response({'status': status})
+    resp.set_etag(str(version), weak=True)
 
     return resp
 
@@ -152,10 +295,18 @@ def response(uuid):
         time.sleep(0.1)
         status = htq.status(uuid)
 
+    version = htq.version(uuid)
+    resp = not_modified(version)
+
+    if resp:
+        return resp
+
     rp = htq.response(uuid) or {}
 
-    resp = make_response(json.dumps(rp), 200)
-    resp.headers['Content-Type'] = 'application/json'
+    resp = make_payload_response(rp)
+
+    if version is not None:
+        resp.set_etag(str(version), weak=True)
     resp.headers['Link'] = build_link_header({
         url_for('response', uuid=uuid, _external=True): {
             'rel': 'self',
@@ -1,10 +1,117 @@
-from .api import REQ_SEND_QUEUE
+import json
+import time
+from .api import (CANCEL_QUEUE, TENANTS, DEFAULT_TENANT, _queue_key,
+                  _valid_weight, requeue_cancel_notices, logger)
 from .db import get_redis_client
 
 
-def iter_queue():
-    "Returns a blocking iterator of request UUIDs from the queue."
+def _weight(tenant, value):
+    "Returns the stored weight of a tenant, or 1 if it is invalid."
+    try:
+        weight = float(value)
+    except ValueError:
+        weight = None
+
+    if _valid_weight(weight):
+        return weight
+
+    logger.warning('invalid weight {!r} of tenant {}, using 1'
+                   .format(value, tenant))
+
+    return 1
+
+
+def iter_batches(quantum=1, timeout=1, refresh=5):
+    """Returns a blocking iterator of batches of request UUIDs from the
+    tenant queues.
+
+    Tenants are served by deficit round-robin. Each round a tenant is
+    credited its weight times the quantum, and as many requests as the
+    credit covers are popped off its queue. The requests of all tenants
+    are popped in one round trip per round. Credit is reset when a tenant's
+    queue runs out so idle tenants do not build it up.
+
+    Invalid stored weights are logged and replaced by 1. The weights are
+    read every `refresh` seconds and whenever the queues
+    are empty. `timeout` is the number of seconds to block waiting for
+    requests before checking for new tenants.
+    """
+    client = get_redis_client()
+    deficits = {}
+    weights = None
+    refreshed = 0
+
+    while True:
+        if weights is None or time.monotonic() - refreshed > refresh:
+            weights = {DEFAULT_TENANT: 1}
+            weights.update((t, _weight(t, w)) for t, w in
+                           client.hgetall(TENANTS).items())
+
+            tenants = sorted(weights)
+            refreshed = time.monotonic()
+
+        counts = []
+
+        for tenant in tenants:
+            deficit = deficits.get(tenant, 0) + quantum * weights[tenant]
+            deficits[tenant] = deficit
+
+            if deficit >= 1:
+                counts.append((tenant, int(deficit)))
+
+        # Requests are popped off the tail of the queues
+        with client.pipeline() as p:
+            for tenant, n in counts:
+                p.lrange(_queue_key(tenant), -n, -1)
+                p.ltrim(_queue_key(tenant), 0, -n - 1)
+
+            results = p.execute()[::2]
+
+        batch = []
+
+        for (tenant, n), uuids in zip(counts, results):
+            if len(uuids) < n:
+                deficits.pop(tenant)
+            else:
+                deficits[tenant] -= n
+
+            batch.extend(reversed(uuids))
+
+        if batch:
+            yield batch
+            continue
+
+        # Pick up new tenants while idle
+        weights = None
+
+        item = client.brpop([_queue_key(t) for t in tenants],
+                            timeout=timeout)
+
+        if item:
+            yield [item[1]]
+
+
+def iter_queue(quantum=1, timeout=1, refresh=5):
+    """Returns a blocking iterator of request UUIDs from the tenant queues.
+    See `iter_batches`.
+    """
+    for batch in iter_batches(quantum, timeout, refresh):
+        for uuid in batch:
+            yield uuid
+
+
+def iter_cancel_queue(timeout=1):
+    """Returns a blocking iterator of cancel notices from the queue.
+
+    Notices whose retry is due are put back on the queue every `timeout`
+    seconds while waiting.
+    """
     client = get_redis_client()
 
     while True:
-        yield client.brpop(REQ_SEND_QUEUE)[1]
+        requeue_cancel_notices()
+
+        item = client.brpop(CANCEL_QUEUE, timeout=timeout)
+
+        if item:
+            yield json.loads(item[1])
@@ -41,6 +41,11 @@ kwargs = {
         'flask>=0.10.1,<0.11',
     ],
 
+    'extras_require': {
+        'async': ['uvicorn'],
+        'msgpack': ['msgpack'],
+    },
+
     'scripts': ['bin/htq'],
 }
 
@@ -1,7 +1,10 @@
+import time
 import unittest
 import responses
 import htq
+from htq import encoding
 from htq.db import get_redis_client
+from htq.utils import iter_batches, iter_queue
 
 
 url = 'http://localhost/'
@@ -51,6 +54,119 @@ class TestCase(unittest.TestCase):
             'Content-Type': 'application/json',
         })
 
+    @responses.activate
+    def test_timing(self):
+        htq.send(url)
+        uuid = htq.pop()
+        resp = htq.receive(uuid)
+
+        timing = htq.response(uuid)['timing']
+        self.assertEqual(timing, resp['timing'])
+
+        order = ['enqueued', 'dequeued', 'claimed', 'sent', 'first_byte',
+                 'complete', 'stored']
+
+        self.assertEqual(set(timing), set(order))
+        self.assertEqual([timing[k] for k in order],
+                         sorted(timing[k] for k in order))
+        self.assertEqual(htq.latency(resp),
+                         (timing['complete'] - timing['sent']) / 1000.0)
+
+        # Each phase is counted once
+        hists = htq.timings()
+        self.assertEqual(sum(hists['total'].values()), 1)
+        self.assertEqual(sum(hists['queue'].values()), 1)
+
+        # Storing the timing changes the version
+        keys = (htq.api.REQ_PREFIX + uuid, htq.api.RESP_PREFIX + uuid)
+        version = htq.version(uuid)
+        htq.api._store_timing(client, *keys, req=htq.request(uuid),
+                              resp=resp)
+        self.assertEqual(htq.version(uuid), version + 1)
+
+        # A purged response is not recreated by the timing
+        htq.purge(uuid)
+        version = htq.version(uuid)
+        htq.api._store_timing(client, *keys, req=htq.request(uuid),
+                              resp=resp)
+        self.assertIsNone(htq.response(uuid))
+        self.assertEqual(htq.version(uuid), version)
+
+        # Only counted again by the first call
+        self.assertEqual(sum(htq.timings()['total'].values()), 2)
+
+    @responses.activate
+    def test_slow_tasks(self):
+        self.addCleanup(setattr, htq.api, 'SLOW_THRESHOLD', None)
+        self.addCleanup(setattr, htq.api, 'SLOW_TASKS_LIMIT',
+                        htq.api.SLOW_TASKS_LIMIT)
+
+        # Not recorded unless a threshold is set
+        htq.send(url)
+        htq.receive(htq.pop())
+        self.assertEqual(htq.slow_tasks(), [])
+
+        htq.api.SLOW_THRESHOLD = 60000
+        htq.send(url)
+        htq.receive(htq.pop())
+        self.assertEqual(htq.slow_tasks(), [])
+
+        htq.api.SLOW_THRESHOLD = -1
+        htq.api.SLOW_TASKS_LIMIT = 2
+        uuids = [htq.send(url)['uuid'] for i in range(3)]
+
+        for i in range(3):
+            htq.receive(htq.pop())
+
+        # Newest first, up to the limit
+        tasks = htq.slow_tasks()
+        self.assertEqual([t['uuid'] for t in tasks], uuids[:0:-1])
+        self.assertEqual(tasks[0]['code'], 200)
+        self.assertIn('first_byte', tasks[0]['phases'])
+
+    @responses.activate
+    def test_hooks(self):
+        calls = []
+
+        def before(uuid):
+            calls.append(('before', uuid))
+
+        def after(uuid, resp):
+            calls.append(('after', uuid, resp['status']))
+
+        def broken(uuid):
+            raise Exception
+
+        htq.add_hook('before_receive', before)
+        htq.add_hook('before_receive', broken)
+        htq.add_hook('after_receive', after)
+
+        try:
+            htq.send(url)
+            uuid = htq.pop()
+            htq.receive(uuid)
+        finally:
+            htq.remove_hook('before_receive', before)
+            htq.remove_hook('before_receive', broken)
+            htq.remove_hook('after_receive', after)
+
+        self.assertEqual(calls, [
+            ('before', uuid),
+            ('after', uuid, htq.SUCCESS),
+        ])
+
+        with self.assertRaises(ValueError):
+            htq.add_hook('foo', before)
+
+    def test_timing_error(self):
+        htq.send('http://localhost:9999')
+        uuid = htq.pop()
+        htq.receive(uuid)
+
+        timing = htq.response(uuid)['timing']
+        self.assertNotIn('first_byte', timing)
+        self.assertEqual(htq.timings()['download'], {})
+
     @responses.activate
     def test_status(self):
         htq.send(url)
@@ -110,6 +226,203 @@ class TestCase(unittest.TestCase):
         self.assertEqual(req['status'], htq.CANCELED)
         self.assertIsNone(resp)
 
+    @responses.activate
+    def test_cancel_pending(self):
+        htq.send(url)
+        uuid = htq.pop()
+
+        # Mark as running
+        client.hset(htq.api.REQ_PREFIX + uuid, 'status', htq.PENDING)
+
+        # Cancel returns without sending the delete request
+        self.assertTrue(htq.cancel(uuid))
+        self.assertEqual(htq.status(uuid), htq.CANCELED)
+        self.assertEqual(len(responses.calls), 0)
+
+        notice = htq.pop_cancel()
+        self.assertEqual(notice, {'uuid': uuid, 'attempt': 1})
+
+        self.assertTrue(htq.receive_cancel(notice))
+        self.assertEqual(responses.calls[0].request.method, 'DELETE')
+
+    def test_cancel_retry(self):
+        htq.send('http://localhost:9999')
+        uuid = htq.pop()
+
+        client.hset(htq.api.REQ_PREFIX + uuid, 'status', htq.PENDING)
+        htq.cancel(uuid)
+
+        self.assertFalse(htq.receive_cancel(htq.pop_cancel()))
+
+        # Retried after the backoff
+        self.assertEqual(htq.requeue_cancel_notices(), 0)
+        self.assertEqual(client.llen(htq.api.CANCEL_QUEUE), 0)
+
+        self.addCleanup(setattr, htq.api, 'CANCEL_BACKOFF',
+                        htq.api.CANCEL_BACKOFF)
+        htq.api.CANCEL_BACKOFF = 0
+        client.delete(htq.api.CANCEL_RETRIES)
+        client.lpush(htq.api.CANCEL_QUEUE, '{"uuid": "%s", "attempt": 2}'
+                     % uuid)
+
+        for attempt in range(2, htq.api.CANCEL_ATTEMPTS + 1):
+            notice = htq.pop_cancel()
+            self.assertEqual(notice['attempt'], attempt)
+            self.assertFalse(htq.receive_cancel(notice))
+
+        # Notice is dropped after the last attempt
+        self.assertEqual(htq.requeue_cancel_notices(), 0)
+        self.assertEqual(client.llen(htq.api.CANCEL_QUEUE), 0)
+
+    def test_breaker(self):
+        breaker = htq.api.breaker
+        threshold = breaker.threshold
+
+        breaker.threshold = 2
+
+        try:
+            for i in range(3):
+                htq.send('http://localhost:9999')
+                resp = htq.receive(htq.pop())
+                self.assertEqual(resp['status'], htq.ERROR)
+                self.assertEqual(htq.latency(resp) is None, i == 2)
+
+            # Third request was rejected without being sent
+            self.assertEqual(resp['message'],
+                             'circuit open for localhost:9999')
+
+            # Other hosts are not affected
+            with responses.RequestsMock() as rsps:
+                rsps.add(responses.GET, url=url, status=200)
+
+                htq.send(url)
+                resp = htq.receive(htq.pop())
+                self.assertEqual(resp['status'], htq.SUCCESS)
+
+            # Probe after the cooldown is sent and fails
+            breaker.cooldown = 0
+            htq.send('http://localhost:9999')
+            resp = htq.receive(htq.pop())
+            self.assertNotIn('circuit open', resp['message'])
+
+            # Deferred requests are put back on the queue after the
+            # cooldown
+            breaker.cooldown = 0.2
+            breaker.defer = True
+            htq.send('http://localhost:9999')
+            uuid = htq.pop()
+            self.assertIsNone(htq.receive(uuid))
+            self.assertEqual(htq.size(), 0)
+            self.assertEqual(htq.requeue_deferred(), 0)
+
+            time.sleep(0.2)
+            self.assertEqual(htq.requeue_deferred(), 1)
+            self.assertEqual(htq.pop(), uuid)
+            self.assertEqual(htq.status(uuid), htq.QUEUED)
+        finally:
+            breaker.threshold = threshold
+            breaker.cooldown = 30
+            breaker.defer = False
+            breaker.reset()
+
+    def test_tenants(self):
+        for i in range(10):
+            htq.send(url, tenant='a')
+
+        for i in range(2):
+            htq.send(url, tenant='b')
+
+        self.assertEqual(htq.size(), 12)
+        self.assertEqual(htq.size(tenant='b'), 2)
+        self.assertEqual(htq.tenants(), {'default': 0, 'a': 10, 'b': 2})
+        self.assertEqual(len(htq.queued(tenant='a')), 10)
+        self.assertEqual(len(htq.queued()), 12)
+
+        # Tenants take turns
+        it = iter_queue()
+        tenants = [htq.request(next(it))['tenant'] for i in range(4)]
+        self.assertEqual(tenants, ['a', 'b', 'a', 'b'])
+
+    def test_tenant_weight(self):
+        for i in range(10):
+            htq.send(url, tenant='a')
+            htq.send(url, tenant='b')
+
+        htq.set_weight('a', 3)
+
+        it = iter_queue()
+        tenants = [htq.request(next(it))['tenant'] for i in range(8)]
+        self.assertEqual(tenants, ['a', 'a', 'a', 'b', 'a', 'a', 'a', 'b'])
+
+        for weight in ('heavy', 0, -1, True, float('inf')):
+            with self.assertRaises(ValueError):
+                htq.set_weight('a', weight)
+
+        # Bad stored weights do not stop the workers or starve the tenant
+        client = htq.db.get_redis_client()
+        client.hset(htq.api.TENANTS, 'a', 'heavy')
+
+        with self.assertLogs('htq', 'WARNING'):
+            it = iter_queue()
+            tenants = [htq.request(next(it))['tenant'] for i in range(4)]
+
+        self.assertEqual(tenants, ['a', 'b', 'a', 'b'])
+
+    def test_batches(self):
+        uuids = [htq.send(url)['uuid'] for i in range(5)]
+
+        # Popped oldest first, a batch per round
+        it = iter_batches(quantum=3)
+        self.assertEqual(next(it), uuids[:3])
+        self.assertEqual(next(it), uuids[3:])
+        self.assertEqual(htq.size(), 0)
+
+        # Claimed as a whole
+        worker_id = htq.register_worker()
+        htq.claim(worker_id, uuids[:3])
+        self.assertEqual(sorted(htq.workers()[0]['in_flight']),
+                         sorted(uuids[:3]))
+
+    @responses.activate
+    def test_deadline(self):
+        req = htq.send(url, ttl=60)
+        self.assertEqual(htq.request(req['uuid'])['deadline'],
+                         req['time'] + 60000)
+
+        # Expired at the time it is received
+        htq.pop()
+        uuid = htq.send(url, deadline=htq.api._timestamp() - 1)['uuid']
+        htq.pop()
+
+        self.assertIsNone(htq.receive(uuid))
+        self.assertEqual(htq.status(uuid), htq.EXPIRED)
+        self.assertEqual(len(responses.calls), 0)
+
+        # Expired requests can still be canceled
+        self.assertTrue(htq.cancel(uuid))
+        self.assertEqual(htq.status(uuid), htq.CANCELED)
+
+        self.assertRaises(ValueError, htq.send, url, ttl='10')
+        self.assertRaises(ValueError, htq.send, url, deadline='soon')
+        self.assertRaises(ValueError, htq.send, url, timeout='10')
+        self.assertRaises(ValueError, htq.send, '')
+        self.assertEqual(htq.size(), 0)
+
+    def test_sweep(self):
+        past = htq.api._timestamp() - 1
+
+        expired = [htq.send(url, deadline=past)['uuid'] for i in range(3)]
+        htq.send(url, ttl=60)
+        htq.send(url)
+
+        self.assertEqual(htq.sweep(), 3)
+        self.assertEqual(htq.size(), 2)
+
+        for uuid in expired:
+            self.assertEqual(htq.status(uuid), htq.EXPIRED)
+
+        self.assertEqual(htq.sweep(), 0)
+
     @responses.activate
     def test_purge(self):
         htq.send(url)
@@ -120,6 +433,64 @@ class TestCase(unittest.TestCase):
 
         resp = htq.response(uuid)
         self.assertIsNone(resp)
+        self.assertIsNone(htq.body(uuid))
+
+    @responses.activate
+    def test_body(self):
+        body = 'déjà'.encode('latin1')
+
+        responses.add(responses.GET,
+                      url=url + 'latin1',
+                      body=body,
+                      content_type='text/plain; charset=iso-8859-1')
+
+        htq.send(url + 'latin1')
+        uuid = htq.pop()
+        htq.receive(uuid)
+
+        # Original bytes and charset are kept
+        resp = htq.response(uuid)
+        self.assertEqual(resp['data'], 'déjà')
+        self.assertEqual(resp['charset'], 'iso-8859-1')
+        self.assertEqual(resp['size'], len(body))
+        self.assertFalse(resp['truncated'])
+        self.assertEqual(htq.body(uuid), body)
+
+        self.addCleanup(setattr, htq.api, 'MAX_BODY_SIZE',
+                        htq.api.MAX_BODY_SIZE)
+        htq.api.MAX_BODY_SIZE = 3
+
+        htq.send(url + 'latin1')
+        uuid = htq.pop()
+        htq.receive(uuid)
+
+        resp = htq.response(uuid)
+        self.assertTrue(resp['truncated'])
+        self.assertEqual(resp['size'], 3)
+        self.assertEqual(htq.body(uuid), body[:3])
+
+    @responses.activate
+    def test_body_chunks(self):
+        body = bytes(range(256)) * 40
+
+        responses.add(responses.GET,
+                      url=url + 'binary',
+                      body=body,
+                      content_type='application/octet-stream')
+
+        self.addCleanup(setattr, htq.api, 'BODY_CHUNK_SIZE',
+                        htq.api.BODY_CHUNK_SIZE)
+        htq.api.BODY_CHUNK_SIZE = 100
+
+        # Spans several pipelines of chunks
+        htq.send(url + 'binary')
+        uuid = htq.pop()
+        htq.receive(uuid)
+
+        self.assertEqual(htq.response(uuid)['size'], len(body))
+        self.assertEqual(htq.body(uuid), body)
+        self.assertEqual(htq.db.get_redis_client()
+                         .llen(htq.api.BODY_PREFIX + uuid), 103)
 
     @responses.activate
     def test_id(self):
@@ -135,3 +506,154 @@ class TestCase(unittest.TestCase):
         uuid = htq.pop()
         req2 = htq.request(uuid)
         self.assertEqual(req2['status'], htq.QUEUED)
+
+    def test_send_many(self):
+        htq.send(url, data='v1', id='foo')
+
+        reqs = htq.send_many([
+            {'url': url, 'data': 'v2', 'id': 'foo'},
+            {'url': url, 'data': 'v3', 'id': 'foo'},
+            {'url': url, 'tenant': 'a'},
+        ])
+
+        self.assertEqual(len(reqs), 3)
+        self.assertEqual(htq.size(), 4)
+        self.assertEqual(htq.size('a'), 1)
+
+        # Only the last request with the id is queued
+        statuses = [htq.status(r['uuid']) for r in reqs]
+        self.assertEqual(statuses, [htq.CANCELED, htq.QUEUED, htq.QUEUED])
+
+    def test_load(self):
+        from htq.load import load
+
+        lines = [
+            '{"url": "http://localhost/", "tenant": "a", "id": 1}',
+            '',
+            'not json',
+            '{"method": "GET"}',
+            '{"url": "http://localhost/", "timeout": "x"}',
+            '{"url": "http://localhost/", "tenant": ""}',
+            '{"url": "http://localhost/", "deadline": 1}',
+            '{"url": "http://localhost/", "timeout": 1.5}',
+        ]
+
+        self.assertEqual(load(lines, batch_size=1), (2, 5))
+        self.assertEqual(htq.size('a'), 1)
+
+        req = htq.request(htq.pop('a'))
+        self.assertEqual(req['id'], '1')
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack is not installed')
+    @responses.activate
+    def test_compact(self):
+        old = htq.send(url)
+
+        htq.set_compact()
+        self.addCleanup(htq.set_compact, False)
+
+        new = htq.send(url, data='d\u00e9j\u00e0', headers={'A': 'b'},
+                       ttl=60)
+
+        raw = client.hgetall(htq.api.REQ_PREFIX + new['uuid'])
+        self.assertEqual(sorted(raw),
+                         ['_blob', '_v', 'status', 'tenant', 'version'])
+
+        # Both layouts are readable
+        self.assertEqual(htq.request(old['uuid'])['url'], url)
+
+        req = htq.request(new['uuid'])
+        self.assertEqual(req['data'], 'd\u00e9j\u00e0')
+        self.assertEqual(req['headers'], {'A': 'b'})
+        self.assertEqual(req['deadline'], new['deadline'])
+
+        htq.pop()
+        uuid = htq.pop()
+        htq.receive(uuid)
+
+        resp = htq.response(uuid)
+        self.assertEqual(resp['code'], 201)
+        self.assertIn('timing', resp)
+        self.assertEqual(htq.status(uuid), htq.SUCCESS)
+
+    @responses.activate
+    def test_batch(self):
+        uuids = [htq.send(url)['uuid'] for i in range(3)]
+
+        htq.pop()
+        htq.receive(uuids[0])
+        htq.cancel(uuids[1])
+
+        self.assertEqual(htq.statuses(uuids + ['foo']), {
+            uuids[0]: htq.SUCCESS,
+            uuids[1]: htq.CANCELED,
+            uuids[2]: htq.QUEUED,
+        })
+
+        self.assertEqual(htq.statuses(uuids, completed=True), {
+            uuids[0]: htq.SUCCESS,
+            uuids[1]: htq.CANCELED,
+        })
+
+        resps = htq.responses(uuids + ['foo'])
+        self.assertEqual(sorted(resps), sorted(uuids))
+        self.assertEqual(resps[uuids[0]]['code'], 200)
+        self.assertIsNone(resps[uuids[2]])
+
+        resps = htq.responses(uuids, completed=True)
+        self.assertNotIn(uuids[2], resps)
+
+    @responses.activate
+    def test_version(self):
+        uuid = htq.send(url)['uuid']
+        self.assertEqual(htq.version(uuid), 1)
+        self.assertEqual(htq.request(uuid)['version'], 1)
+
+        # Pending, complete and timing stored
+        htq.receive(htq.pop())
+        self.assertEqual(htq.version(uuid), 4)
+
+        htq.purge(uuid)
+        self.assertEqual(htq.version(uuid), 5)
+
+        htq.cancel(uuid)
+        self.assertEqual(htq.version(uuid), 6)
+
+        self.assertIsNone(htq.version('foo'))
+
+    @responses.activate
+    def test_workers(self):
+        live = htq.register_worker({'threads': 2})
+        dead = htq.register_worker(ttl=0.05)
+
+        uuids = [htq.send(url)['uuid'] for i in range(3)]
+
+        # One pending, one waiting to be sent and one finished
+        for i in range(3):
+            htq.claim(dead, htq.pop(), dequeued=1000 + i)
+
+        client.hset(htq.api.REQ_PREFIX + uuids[0], 'status', htq.PENDING)
+        htq.receive(uuids[2])
+
+        htq.claim(live, uuids[2])
+        htq.release(live, uuids[2])
+
+        time.sleep(0.1)
+
+        workers = htq.workers()
+        self.assertEqual([w['id'] for w in workers], [live])
+        self.assertEqual(workers[0]['threads'], 2)
+        self.assertEqual(workers[0]['in_flight'], [])
+
+        self.assertEqual(htq.reap(), 2)
+        self.assertEqual(htq.reap(), 0)
+
+        self.assertEqual(htq.status(uuids[0]), htq.QUEUED)
+        self.assertEqual(htq.size(), 2)
+
+        # The oldest is sent first
+        self.assertEqual(htq.pop(), uuids[0])
+
+        htq.claim(live, uuids[1])
+        self.assertEqual(htq.unregister_worker(live), 1)
+        self.assertEqual(htq.workers(), [])
@@ -0,0 +1,133 @@
+import gzip
+import shutil
+import tempfile
+import unittest
+import responses
+import htq
+from htq.archive import Archive, set_archive
+
+
+url = 'http://localhost/'
+
+
+class ArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write_get(self):
+        archive = Archive(self.path, member_size=2)
+        archive.write([{'uuid': str(i), 'n': i} for i in range(5)])
+
+        self.assertEqual(len(archive), 5)
+        self.assertIn('3', archive)
+        self.assertEqual(archive.get('3'), {'uuid': '3', 'n': 3})
+        self.assertIsNone(archive.get('6'))
+
+        # Segments are readable as a whole
+        self.assertEqual([r['n'] for r in archive], list(range(5)))
+
+    def test_rotate(self):
+        archive = Archive(self.path, segment_size=1, member_size=1)
+        archive.write([{'uuid': 'a'}, {'uuid': 'b'}])
+        archive.write([{'uuid': 'c'}])
+
+        self.assertEqual(archive.segments(), [1, 2, 3])
+        self.assertEqual(archive.get('b'), {'uuid': 'b'})
+
+        with gzip.open(archive._segment_path(3), 'rt') as f:
+            self.assertEqual(f.read(), '{"uuid": "c"}\n')
+
+
+class ApiTestCase(unittest.TestCase):
+    def setUp(self):
+        htq.flush()
+
+        self.path = tempfile.mkdtemp()
+        set_archive(self.path)
+
+        responses.add(responses.GET,
+                      url=url,
+                      body='{"ok": 1}',
+                      status=200,
+                      content_type='application/json')
+
+    def tearDown(self):
+        set_archive(None)
+        shutil.rmtree(self.path)
+
+    @responses.activate
+    def test_archive(self):
+        htq.send(url, id='foo')
+        uuid = htq.pop()
+        htq.receive(uuid)
+
+        htq.send(url)
+        queued = htq.pop()
+
+        # Not old enough
+        self.assertEqual(htq.archive(60), 0)
+
+        self.assertEqual(htq.archive(0), 1)
+        self.assertEqual(htq.archive(0), 0)
+
+        # Removed from storage, read from the archive
+        self.assertIsNone(htq.db.get_redis_client()
+                          .hget(htq.api.REQ_IDS, 'foo'))
+        self.assertEqual(htq.status(uuid), htq.SUCCESS)
+        self.assertEqual(htq.request(uuid)['url'], url)
+        self.assertEqual(htq.response(uuid)['code'], 200)
+        self.assertEqual(htq.statuses([uuid, queued], completed=True),
+                         {uuid: htq.SUCCESS})
+        self.assertEqual(htq.responses([uuid])[uuid]['code'], 200)
+
+        # Queued requests are not archived
+        self.assertEqual(htq.status(queued), htq.QUEUED)
+
+    def test_terminal(self):
+        canceled = htq.send(url)['uuid']
+        htq.cancel(canceled)
+        htq.pop()
+
+        swept = htq.send(url, deadline=0)['uuid']
+        htq.sweep()
+
+        expired = htq.send(url, deadline=0)['uuid']
+        htq.receive(htq.pop())
+
+        # Requests that end without a response are archived as well
+        self.assertEqual(htq.archive(0), 3)
+        self.assertEqual(htq.status(canceled), htq.CANCELED)
+        self.assertEqual(htq.status(swept), htq.EXPIRED)
+        self.assertEqual(htq.status(expired), htq.EXPIRED)
+
+    @responses.activate
+    def test_body(self):
+        body = bytes(range(256))
+
+        responses.add(responses.GET,
+                      url=url + 'binary',
+                      body=body,
+                      content_type='application/octet-stream')
+
+        htq.send(url + 'binary')
+        uuid = htq.pop()
+        htq.receive(uuid)
+
+        self.assertEqual(htq.archive(0), 1)
+
+        # The original bytes are kept
+        self.assertEqual(htq.body(uuid), body)
+        self.assertEqual(htq.response(uuid)['size'], len(body))
+
+    @responses.activate
+    def test_purged(self):
+        htq.send(url)
+        uuid = htq.pop()
+        htq.receive(uuid)
+        htq.purge(uuid)
+
+        self.assertEqual(htq.archive(0), 0)
+        self.assertEqual(htq.status(uuid), htq.SUCCESS)
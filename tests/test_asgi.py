@@ -0,0 +1,206 @@
+import json
+import asyncio
+import unittest
+import responses
+import htq
+from htq import profiler
+from htq.asgi import app
+
+
+url = 'http://localhost/'
+
+
+async def call(method, path, body=b'', disconnect=None, headers=()):
+    "Calls the app and returns the status, headers and body of the response."
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path.split('?')[0],
+        'query_string': path.partition('?')[2].encode(),
+        'scheme': 'http',
+        'server': ('testserver', 80),
+        'headers': [(b'host', b'testserver')] + [
+            (k.encode(), v.encode()) for k, v in headers],
+    }
+
+    sent = []
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+
+        # Wait for the client to go away
+        await (disconnect or asyncio.Event()).wait()
+
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+
+    if not sent:
+        return None, {}, None
+
+    headers = {k.decode(): v.decode() for k, v in sent[0]['headers']}
+
+    return sent[0]['status'], headers, sent[1]['body']
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        htq.flush()
+
+        responses.add(responses.GET,
+                      url=url,
+                      body='{"ok": 1}',
+                      status=200,
+                      content_type='application/json')
+
+    def test_root(self):
+        status, headers, body = run(call('GET', '/'))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['link'], '<http://testserver/>; rel="self"')
+
+    def test_send(self):
+        status, headers, body = run(call('POST', '/', json.dumps({
+            'url': url,
+            'tenant': 'a',
+        }).encode()))
+
+        self.assertEqual(status, 303)
+
+        path = headers['location'][len('http://testserver'):]
+        status, headers, body = run(call('GET', path))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())['tenant'], 'a')
+        self.assertIn('rel="status"', headers['link'])
+
+        status, headers, body = run(call('GET', '/?tenant=a'))
+        self.assertEqual(len(json.loads(body.decode())), 1)
+
+    def test_invalid(self):
+        self.assertEqual(run(call('POST', '/', b'{}'))[0], 422)
+        self.assertEqual(run(call('POST', '/', json.dumps({
+            'url': url, 'ttl': '10'}).encode()))[0], 422)
+        self.assertEqual(run(call('POST', '/', b'not json'))[0], 400)
+        self.assertEqual(run(call('GET', '/foo/'))[0], 404)
+        self.assertEqual(run(call('GET', '/foo/status/'))[0], 404)
+        self.assertEqual(run(call('PUT', '/foo/'))[0], 405)
+        self.assertEqual(run(call('GET', '/foo/bar/'))[0], 404)
+
+    @responses.activate
+    def test_response(self):
+        htq.send(url)
+        uuid = htq.pop()
+
+        async def wait():
+            loop = asyncio.get_running_loop()
+            waiting = asyncio.ensure_future(
+                call('GET', '/{}/response/'.format(uuid)))
+
+            await asyncio.sleep(0.2)
+            self.assertFalse(waiting.done())
+
+            await loop.run_in_executor(None, htq.receive, uuid)
+
+            return await waiting
+
+        status, headers, body = run(wait())
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode())['code'], 200)
+
+        status, headers, body = run(call('GET', '/{}/status/'.format(uuid)))
+        self.assertEqual(json.loads(body.decode()), {'status': htq.SUCCESS})
+
+        self.assertEqual(run(call('DELETE',
+                                  '/{}/response/'.format(uuid)))[0], 204)
+
+    def test_disconnect(self):
+        htq.send(url)
+        uuid = htq.pop()
+
+        async def wait():
+            disconnect = asyncio.Event()
+            waiting = asyncio.ensure_future(
+                call('GET', '/{}/response/'.format(uuid),
+                     disconnect=disconnect))
+
+            await asyncio.sleep(0.2)
+            disconnect.set()
+
+            return await waiting
+
+        # Nothing is sent to a client that went away
+        self.assertEqual(run(wait()), (None, {}, None))
+
+    def test_cancel(self):
+        htq.send(url)
+        uuid = htq.pop()
+
+        self.assertEqual(run(call('DELETE', '/{}/'.format(uuid)))[0], 204)
+        self.assertEqual(htq.status(uuid), htq.CANCELED)
+
+    @responses.activate
+    def test_batch(self):
+        uuids = [htq.send(url)['uuid'] for i in range(2)]
+        htq.receive(htq.pop())
+
+        status, headers, body = run(call('POST', '/status', json.dumps({
+            'uuids': uuids + ['foo'],
+            'completed': True,
+        }).encode()))
+
+        self.assertEqual(json.loads(body.decode()), {uuids[0]: htq.SUCCESS})
+
+        status, headers, body = run(call('POST', '/responses', json.dumps({
+            'uuids': uuids,
+        }).encode()))
+
+        data = json.loads(body.decode())
+        self.assertEqual(data[uuids[0]]['code'], 200)
+        self.assertIsNone(data[uuids[1]])
+
+        status, headers, body = run(call('POST', '/status', b'[]'))
+        self.assertEqual(status, 400)
+
+    @responses.activate
+    def test_etag(self):
+        uuid = htq.send(url)['uuid']
+        path = '/{}/status/'.format(uuid)
+
+        status, headers, body = run(call('GET', path))
+        etag = headers['etag']
+        self.assertEqual(headers['vary'], 'Accept')
+
+        status, headers, body = run(call('GET', path, headers=[
+            ('if-none-match', etag)]))
+        self.assertEqual((status, body), (304, b''))
+        self.assertEqual(headers['vary'], 'Accept')
+
+        htq.receive(htq.pop())
+
+        status, headers, body = run(call('GET', path, headers=[
+            ('if-none-match', etag)]))
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers['etag'], etag)
+
+    def test_profile(self):
+        self.assertEqual(run(call('GET', '/profile'))[0], 404)
+
+        self.addCleanup(profiler.enable, False)
+        profiler.enable()
+
+        status, headers, body = run(call('GET', '/profile?seconds=0.1'))
+        self.assertEqual(status, 200)
+
+        status, headers, body = run(call('GET', '/slow?limit=x'))
+        self.assertEqual(json.loads(body.decode()), [])
@@ -0,0 +1,275 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import redis
+from htq.backends import get_backend
+from htq.backends.memory import MemoryClient
+from htq.backends.sqlite import SQLiteClient
+
+
+class BackendTestMixin(object):
+    def test_hash(self):
+        c = self.client
+
+        self.assertEqual(c.hset('h', 'a', 1), 1)
+        self.assertEqual(c.hset('h', 'a', 2), 0)
+        self.assertTrue(c.hmset('h', {'b': 'x', 'c': None}))
+
+        self.assertEqual(c.hget('h', 'a'), '2')
+        self.assertIsNone(c.hget('h', 'z'))
+        self.assertIsNone(c.hget('missing', 'a'))
+        self.assertEqual(c.hgetall('h'), {'a': '2', 'b': 'x', 'c': 'None'})
+        self.assertEqual(c.hgetall('missing'), {})
+
+        self.assertFalse(c.hsetnx('h', 'a', 3))
+        self.assertTrue(c.hsetnx('h', 'n', 0))
+        self.assertEqual(c.hincrby('h', 'n'), 1)
+        self.assertEqual(c.hincrby('h', 'n', 5), 6)
+
+        with self.assertRaises(redis.ResponseError):
+            c.hincrby('h', 'b')
+
+        self.assertEqual(c.hmget('h', ['a', 'z', 'b']), ['2', None, 'x'])
+        self.assertEqual(c.hmget('h', 'a', 'b'), ['2', 'x'])
+
+        self.assertEqual(c.hdel('h', 'a', 'z'), 1)
+        self.assertIsNone(c.hget('h', 'a'))
+        self.assertEqual(c.hdel('h', 'b', 'c', 'n'), 3)
+
+        # Empty hashes are removed
+        self.assertEqual(c.exists('h'), 0)
+
+    def test_list(self):
+        c = self.client
+
+        self.assertEqual(c.lpush('l', 'a', 'b'), 2)
+        self.assertEqual(c.rpush('l', 'c'), 3)
+        self.assertEqual(c.llen('l'), 3)
+        self.assertEqual(c.lrange('l', 0, -1), ['b', 'a', 'c'])
+        self.assertEqual(c.lrange('l', 1, 1), ['a'])
+        self.assertEqual(c.lrange('l', -2, 10), ['a', 'c'])
+
+        self.assertEqual(c.rpop('l'), 'c')
+        self.assertEqual(c.brpop('l'), ('l', 'a'))
+        self.assertEqual(c.brpop(['x', 'l']), ('l', 'b'))
+
+        # Empty lists are removed
+        self.assertEqual(c.exists('l'), 0)
+        self.assertIsNone(c.rpop('l'))
+        self.assertIsNone(c.brpop('l', timeout=0.1))
+
+    def test_lrem(self):
+        c = self.client
+
+        c.rpush('l', 'a', 'b', 'a', 'c', 'a')
+
+        self.assertEqual(c.lrem('l', -1, 'a'), 1)
+        self.assertEqual(c.lrange('l', 0, -1), ['a', 'b', 'a', 'c'])
+
+        self.assertEqual(c.lrem('l', 1, 'a'), 1)
+        self.assertEqual(c.lrange('l', 0, -1), ['b', 'a', 'c'])
+
+        self.assertEqual(c.lrem('l', 0, 'x'), 0)
+        self.assertEqual(c.lrem('l', 0, 'a'), 1)
+        self.assertEqual(c.lrange('l', 0, -1), ['b', 'c'])
+
+    def test_ltrim(self):
+        c = self.client
+
+        c.rpush('l', 'a', 'b', 'c', 'd')
+
+        self.assertTrue(c.ltrim('l', 1, 10))
+        self.assertEqual(c.lrange('l', 0, -1), ['b', 'c', 'd'])
+
+        c.ltrim('l', 0, -2)
+        self.assertEqual(c.lrange('l', 0, -1), ['b', 'c'])
+        self.assertEqual(c.llen('l'), 2)
+
+        # Empty lists are removed
+        c.ltrim('l', 5, 10)
+        self.assertEqual(c.exists('l'), 0)
+
+    def test_sorted_set(self):
+        c = self.client
+
+        self.assertEqual(c.zadd('z', 3, 'c', 1, 'a', b=2), 3)
+        self.assertEqual(c.zadd('z', 0, 'c'), 0)
+        self.assertEqual(c.zcard('z'), 3)
+
+        self.assertEqual(c.zrangebyscore('z', '-inf', '+inf'),
+                         ['c', 'a', 'b'])
+        self.assertEqual(c.zrangebyscore('z', 1, '(2'), ['a'])
+        self.assertEqual(c.zrangebyscore('z', 0, 10, start=1, num=1), ['a'])
+        self.assertEqual(c.zrangebyscore('z', 2, 2, withscores=True),
+                         [('b', 2.0)])
+
+        self.assertEqual(c.zrem('z', 'a', 'x'), 1)
+        self.assertEqual(c.zrem('z', 'b', 'c'), 2)
+        self.assertEqual(c.exists('z'), 0)
+
+    def test_blocking_pop(self):
+        c = self.client
+
+        t = threading.Timer(0.1, c.lpush, args=('l', 'a'))
+        t.start()
+
+        self.assertEqual(c.brpop('l', timeout=5), ('l', 'a'))
+        t.join()
+
+    def test_string(self):
+        c = self.client
+
+        self.assertTrue(c.set('s', 1))
+        self.assertEqual(c.get('s'), '1')
+        self.assertIsNone(c.get('missing'))
+
+        # Replaces keys of any type
+        c.hset('h', 'a', 1)
+        c.set('h', 'x')
+        self.assertEqual(c.get('h'), 'x')
+
+        with self.assertRaises(redis.ResponseError):
+            c.hget('s', 'a')
+
+    def test_expire(self):
+        c = self.client
+
+        c.set('s', 'a', px=50)
+        c.set('t', 'b', ex=60)
+        self.assertEqual(c.exists('s', 't'), 2)
+
+        time.sleep(0.1)
+
+        self.assertIsNone(c.get('s'))
+        self.assertEqual(c.exists('s', 't'), 1)
+        self.assertEqual(c.delete('s', 't'), 1)
+
+        # Setting a key again clears the expire
+        c.set('s', 'a', px=50)
+        c.set('s', 'b')
+        time.sleep(0.1)
+        self.assertEqual(c.get('s'), 'b')
+
+    def test_wrong_type(self):
+        c = self.client
+
+        c.lpush('l', 'a')
+
+        with self.assertRaises(redis.ResponseError):
+            c.hget('l', 'a')
+
+        with self.assertRaises(redis.ResponseError):
+            c.hset('l', 'a', 1)
+
+    def test_delete(self):
+        c = self.client
+
+        c.lpush('l', 'a')
+        c.hset('h', 'a', 1)
+
+        self.assertEqual(c.delete('l', 'h', 'missing'), 2)
+        self.assertEqual(c.exists('l', 'h'), 0)
+        self.assertEqual(c.llen('l'), 0)
+
+    def test_pipeline(self):
+        c = self.client
+
+        with c.pipeline() as p:
+            p.hset('h', 'a', 1)
+            p.lpush('l', 'a')
+            self.assertEqual(c.exists('h'), 0)
+            self.assertEqual(p.execute(), [1, 1])
+
+        self.assertEqual(c.hget('h', 'a'), '1')
+
+    def test_watch(self):
+        c = self.client
+
+        c.hset('h', 'a', 1)
+
+        with c.pipeline() as p:
+            p.watch('h')
+            p.multi()
+            p.hset('h', 'a', 2)
+            p.execute()
+
+        self.assertEqual(c.hget('h', 'a'), '2')
+
+        with c.pipeline() as p:
+            p.watch('h')
+
+            # Immediate mode
+            self.assertEqual(p.hget('h', 'a'), '2')
+
+            # Concurrent write
+            c.hset('h', 'a', 3)
+
+            p.multi()
+            p.hset('h', 'a', 4)
+
+            with self.assertRaises(redis.WatchError):
+                p.execute()
+
+        self.assertEqual(c.hget('h', 'a'), '3')
+
+
+class MemoryTestCase(BackendTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.client = MemoryClient()
+
+
+class SQLiteTestCase(BackendTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.client = SQLiteClient(os.path.join(self.dir, 'htq.db'))
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.dir)
+
+    def test_shared(self):
+        other = SQLiteClient(self.client.path)
+
+        self.client.lpush('l', 'a')
+        self.assertEqual(other.rpop('l'), 'a')
+
+        other.close()
+
+    def test_concurrent_reads(self):
+        c = self.client
+        c.hset('h', 'a', '1')
+        c.rpush('l', 'a')
+
+        writer = SQLiteClient(c.path, timeout=0.1)
+
+        # Reads and read-only pipelines do not wait on a writer
+        with writer._atomic():
+            writer.hset('h', 'a', '2')
+
+            self.assertEqual(c.hget('h', 'a'), '1')
+            self.assertEqual(c.lrange('l', 0, -1), ['a'])
+
+            with c.pipeline() as p:
+                p.hgetall('h')
+                p.llen('l')
+                self.assertEqual(p.execute(), [{'a': '1'}, 1])
+
+            self.assertIsNone(c.brpop('x', timeout=0.1))
+
+        self.assertEqual(c.hget('h', 'a'), '2')
+
+        writer.close()
+
+
+class GetBackendTestCase(unittest.TestCase):
+    def test_urls(self):
+        self.assertIsInstance(get_backend('memory://'), MemoryClient)
+        self.assertIsInstance(get_backend('sqlite://'), SQLiteClient)
+        self.assertIsInstance(get_backend('redis://localhost:6379/0'),
+                              redis.StrictRedis)
+
+        with self.assertRaises(ValueError):
+            get_backend('foo://')
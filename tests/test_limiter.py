@@ -0,0 +1,108 @@
+import threading
+import unittest
+from htq.limiter import AIMDLimiter
+
+
+class TestCase(unittest.TestCase):
+    def complete(self, limiter, n, latency=0.1, timeout=False, error=False):
+        for i in range(n):
+            limiter.acquire()
+            limiter.release(latency=latency, timeout=timeout, error=error)
+
+    def test_increase(self):
+        limiter = AIMDLimiter(floor=1, ceiling=4)
+        self.assertEqual(limiter.limit, 1)
+
+        # One per limit's worth of completions
+        self.complete(limiter, 1)
+        self.assertEqual(limiter.limit, 2)
+
+        self.complete(limiter, 2)
+        self.assertEqual(limiter.limit, 3)
+
+        self.complete(limiter, 100)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_no_backlog(self):
+        limiter = AIMDLimiter(floor=1, ceiling=4, backlog=lambda: 0)
+        self.complete(limiter, 10)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_timeout(self):
+        limiter = AIMDLimiter(floor=2, ceiling=16, initial=16)
+
+        # Decreases once per window
+        self.complete(limiter, 16, timeout=True)
+        self.assertEqual(limiter.limit, 8)
+
+        self.complete(limiter, 100, timeout=True)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_timeout_window(self):
+        limiter = AIMDLimiter(floor=1, ceiling=16, initial=10)
+
+        # A timeout anywhere in the window counts
+        self.complete(limiter, 9, timeout=True)
+        self.complete(limiter, 1)
+        self.assertEqual(limiter.limit, 5)
+
+        self.complete(limiter, 1, timeout=True)
+        self.complete(limiter, 4)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_errors(self):
+        limiter = AIMDLimiter(floor=1, ceiling=16, initial=10)
+
+        # Tolerated up to the error rate
+        self.complete(limiter, 5, error=True)
+        self.complete(limiter, 5)
+        self.assertEqual(limiter.limit, 11)
+
+        self.complete(limiter, 6, error=True)
+        self.complete(limiter, 5)
+        self.assertEqual(limiter.limit, 5)
+
+    def test_latency(self):
+        limiter = AIMDLimiter(floor=1, ceiling=16, initial=8, smoothing=1)
+
+        self.complete(limiter, 8, latency=0.1)
+        self.assertEqual(limiter.limit, 9)
+
+        self.complete(limiter, 9, latency=1)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_skipped(self):
+        limiter = AIMDLimiter(floor=1, ceiling=50, initial=50)
+
+        # Requests that were not sent do not lower the baseline
+        self.complete(limiter, 300, latency=None)
+        self.complete(limiter, 3000, latency=0.1)
+        self.assertEqual(limiter.limit, 50)
+
+        # As they would if their latency counted
+        self.complete(limiter, 300, latency=0.001)
+        self.complete(limiter, 3000, latency=0.1)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_acquire(self):
+        limiter = AIMDLimiter(floor=1, ceiling=1)
+        limiter.acquire()
+
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        t = threading.Thread(target=acquire)
+        t.start()
+
+        self.assertFalse(acquired.wait(0.1))
+
+        limiter.release()
+        self.assertTrue(acquired.wait(1))
+        t.join()
+
+    def test_bounds(self):
+        with self.assertRaises(ValueError):
+            AIMDLimiter(floor=5, ceiling=4)
@@ -0,0 +1,69 @@
+import unittest
+import requests
+from htq import metrics
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        c = self.registry.register(metrics.Counter(
+            'requests_total', 'Requests.', labels=('status',)))
+
+        c.inc(status='ok')
+        c.inc(2, status='ok')
+        c.inc(status='error')
+
+        with self.assertRaises(ValueError):
+            c.inc()
+
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{status="error"} 1.0',
+            'requests_total{status="ok"} 3.0',
+        ]) + '\n')
+
+    def test_gauge(self):
+        g = self.registry.register(metrics.Gauge('in_flight', 'In flight.'))
+        g.inc()
+        g.inc()
+        g.dec()
+
+        f = self.registry.register(metrics.Gauge('depth', 'Depth.',
+                                                 func=lambda: 5))
+
+        self.assertIn('in_flight 1.0', g.render())
+        self.assertIn('depth 5.0', f.render())
+
+    def test_histogram(self):
+        h = self.registry.register(metrics.Histogram(
+            'latency_seconds', 'Latency.', buckets=(0.1, 1)))
+
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5)
+
+        self.assertEqual(h.render().split('\n')[2:], [
+            'latency_seconds_bucket{le="0.1"} 1.0',
+            'latency_seconds_bucket{le="1.0"} 2.0',
+            'latency_seconds_bucket{le="+Inf"} 3.0',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3.0',
+        ])
+
+    def test_http_server(self):
+        self.registry.register(metrics.Counter('n', 'N.')).inc()
+
+        server = metrics.start_http_server(0, host='127.0.0.1',
+                                           registry=self.registry)
+
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_port)
+            resp = requests.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('n 1.0', resp.text)
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,79 @@
+import os
+import signal
+import shutil
+import tempfile
+import threading
+import unittest
+from htq import profiler
+
+
+def spin(started, done):
+    started.set()
+
+    while not done.is_set():
+        pass
+
+
+def spinning():
+    "Starts a busy thread and returns the event that stops it."
+    started, done = threading.Event(), threading.Event()
+    t = threading.Thread(target=spin, args=(started, done))
+    t.start()
+    started.wait()
+
+    return t, done
+
+
+class TestCase(unittest.TestCase):
+    def test_sample(self):
+        t, done = spinning()
+
+        try:
+            sampler = profiler.Sampler()
+            sampler.sample()
+        finally:
+            done.set()
+            t.join()
+
+        self.assertEqual(sampler.samples, 1)
+
+        lines = sampler.collapsed().splitlines()
+        stack, n = lines[0].rsplit(' ', 1)
+        self.assertEqual(n, '1')
+
+        # Outermost frame first
+        stacks = [line.rsplit(' ', 1)[0].split(';') for line in lines]
+        self.assertTrue(any(f.startswith('spin (') for s in stacks
+                            for f in s))
+
+    def test_profile(self):
+        t, done = spinning()
+
+        try:
+            stacks = profiler.profile(0.1, interval=0.01)
+        finally:
+            done.set()
+            t.join()
+
+        self.assertIn('spin (tests/test_profiler.py:', stacks)
+        self.assertNotIn('_run (htq/profiler.py', stacks)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'no SIGUSR1')
+    def test_signal(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        previous = signal.getsignal(signal.SIGUSR1)
+        self.addCleanup(signal.signal, signal.SIGUSR1, previous)
+
+        sampler = profiler.install_signal_handler(path, interval=0.01)
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertTrue(sampler.running)
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertFalse(sampler.running)
+
+        files = os.listdir(path)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].endswith('.collapsed'))
@@ -2,7 +2,7 @@ import json
 import unittest
 import responses
 import htq
-from htq import service
+from htq import service, encoding, profiler
 from htq.db import get_redis_client
 from requests.utils import parse_header_links as phl
 
@@ -62,6 +62,36 @@ class TestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('status', json.loads(resp.data.decode('utf8')))
 
+    def test_send_invalid(self):
+        for attrs in ({'ttl': '10'}, {'deadline': 'soon'},
+                      {'deadline': 1.5}, {'tenant': 5}, {'tenant': ''},
+                      {'timeout': '10'}, {'headers': []}):
+            attrs['url'] = url
+
+            resp = app.post('/', data=json.dumps(attrs),
+                            headers={'content-type': 'application/json'})
+
+            self.assertEqual(resp.status_code, 422)
+
+        # Nothing is queued
+        self.assertEqual(htq.size(), 0)
+
+    @responses.activate
+    def test_send_tenant(self):
+        resp = app.post('/', data=json.dumps({
+            'url': url,
+            'tenant': 'a',
+        }), headers={'content-type': 'application/json'})
+
+        resp = app.get(resp.location)
+        self.assertEqual(json.loads(resp.data.decode('utf8'))['tenant'], 'a')
+
+        resp = app.get('/?tenant=a')
+        self.assertEqual(len(json.loads(resp.data.decode('utf8'))), 1)
+
+        resp = app.get('/?tenant=b')
+        self.assertEqual(json.loads(resp.data.decode('utf8')), [])
+
     @responses.activate
     def test_status(self):
         resp = app.post('/', data=json.dumps({
@@ -100,6 +130,30 @@ class TestCase(unittest.TestCase):
         resp = app.delete(response_url)
         self.assertEqual(resp.status_code, 404)
 
+    @responses.activate
+    def test_metrics(self):
+        htq.send(url)
+        htq.receive(htq.pop())
+
+        resp = app.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+
+        data = resp.data.decode('utf8')
+        self.assertIn('htq_queue_depth 0.0', data)
+        self.assertIn('htq_upstream_seconds_count{host="localhost",'
+                      'status="200"}', data)
+
+    @responses.activate
+    def test_timings(self):
+        htq.send(url)
+        htq.receive(htq.pop())
+
+        resp = app.get('/timings/')
+        self.assertEqual(resp.status_code, 200)
+
+        data = json.loads(resp.data.decode('utf8'))
+        self.assertEqual(sum(data['total'].values()), 1)
+
     @responses.activate
     def test_cancel(self):
         resp = app.post('/', data=json.dumps({
@@ -114,3 +168,120 @@ class TestCase(unittest.TestCase):
         resp = app.get(location)
         data = json.loads(resp.data.decode('utf8'))
         self.assertEqual(data['status'], htq.CANCELED)
+
+    @unittest.skipIf(encoding.msgpack is None, 'msgpack is not installed')
+    @responses.activate
+    def test_msgpack(self):
+        resp = app.post('/', data=encoding.dumps({
+            'url': url,
+        }, encoding.MSGPACK), headers={'content-type': encoding.MSGPACK})
+
+        self.assertEqual(resp.status_code, 303)
+
+        location = resp.location
+        resp = app.get(location, headers={'accept': encoding.MSGPACK})
+
+        self.assertEqual(resp.headers['Content-Type'], encoding.MSGPACK)
+        self.assertEqual(resp.headers['Vary'], 'Accept')
+        self.assertEqual(encoding.loads(resp.data, encoding.MSGPACK)['url'],
+                         url)
+
+        # JSON by default
+        resp = app.get(location)
+        self.assertEqual(resp.headers['Content-Type'], encoding.JSON)
+
+    @responses.activate
+    def test_batch(self):
+        uuids = [htq.send(url)['uuid'] for i in range(2)]
+        htq.receive(htq.pop())
+
+        resp = app.post('/status', data=json.dumps({
+            'uuids': uuids + ['foo'],
+        }), headers={'content-type': 'application/json'})
+
+        self.assertEqual(json.loads(resp.data.decode('utf8')), {
+            uuids[0]: htq.SUCCESS,
+            uuids[1]: htq.QUEUED,
+        })
+
+        resp = app.post('/responses', data=json.dumps({
+            'uuids': uuids,
+            'completed': True,
+        }), headers={'content-type': 'application/json'})
+
+        data = json.loads(resp.data.decode('utf8'))
+        self.assertEqual(list(data), [uuids[0]])
+        self.assertEqual(data[uuids[0]]['code'], 200)
+
+        resp = app.post('/status', data=json.dumps({
+            'uuids': 'foo',
+        }), headers={'content-type': 'application/json'})
+
+        self.assertEqual(resp.status_code, 422)
+
+    @responses.activate
+    def test_etag(self):
+        uuid = htq.send(url)['uuid']
+
+        resp = app.get('/{}/status/'.format(uuid))
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, 'W/"1"')
+
+        resp = app.get('/{}/status/'.format(uuid),
+                       headers={'if-none-match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['Vary'], 'Accept')
+
+        resp = app.get('/{}/'.format(uuid), headers={'if-none-match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        htq.receive(htq.pop())
+
+        # Changed
+        resp = app.get('/{}/'.format(uuid), headers={'if-none-match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+        # Bumped once the timing is stored after the response
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, 'W/"4"')
+
+        resp = app.get('/{}/response/'.format(uuid))
+        etag = resp.headers['ETag']
+
+        resp = app.get('/{}/response/'.format(uuid),
+                       headers={'if-none-match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_workers(self):
+        worker_id = htq.register_worker({'threads': 1})
+
+        resp = app.get('/workers')
+        workers = json.loads(resp.data.decode('utf8'))
+
+        self.assertEqual([w['id'] for w in workers], [worker_id])
+
+    @responses.activate
+    def test_slow(self):
+        self.addCleanup(setattr, htq.api, 'SLOW_THRESHOLD', None)
+        htq.api.SLOW_THRESHOLD = -1
+
+        htq.send(url)
+        htq.receive(htq.pop())
+
+        resp = app.get('/slow?limit=5')
+        tasks = json.loads(resp.data.decode('utf8'))
+
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0]['url'], url)
+
+    def test_profile(self):
+        # Off unless turned on
+        self.assertEqual(app.get('/profile').status_code, 404)
+
+        self.addCleanup(profiler.enable, False)
+        profiler.enable()
+
+        resp = app.get('/profile?seconds=0.1')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Type'], profiler.CONTENT_TYPE)